@@ -5,6 +5,7 @@ from streamlit_sortables import sort_items
 import os
 from io import BytesIO
 from utils.clustering_comments_dbscan import *  # Импортируем модуль кластеризации
+from utils.embedding_cache import EmbeddingCache  # Дисковый кэш эмбеддингов
 from utils.search_notebooks import *  # Импортируем функцию поиска по ноутбукам
 from utils.results_students import * # Импортируем модуль агрегации результатов
 import re
@@ -134,6 +135,28 @@ def sort_files_by_number(files):
 
 
 
+# Число процессов для подготовки задач загруженной таблицы (по умолчанию последовательно)
+CLUSTERING_JOBS = int(os.environ.get("CLUSTERING_JOBS", "1"))
+# Способ упорядочивания комментариев в кластере: pca, spectral, chain или umap
+RANKING_ENGINE = os.environ.get("RANKING_ENGINE", "pca")
+# Число потоков для ранжирования кластеров одной задачи (по умолчанию последовательно)
+RANKING_JOBS = int(os.environ.get("RANKING_JOBS", "1"))
+# Словарь TF-IDF курса, общий для всех загружаемых таблиц; включается только явно, так как таблицы
+# разных курсов не должны смешиваться в одном словаре (по умолчанию TF-IDF обучается на каждой задаче)
+VOCABULARY_PATH = os.environ.get("CLUSTERING_VOCABULARY") or None
+
+
+@st.cache_resource(show_spinner="Загрузка модели эмбеддингов...")
+def load_embedder():
+    """Загружает модель один раз на процесс; экземпляр переживает перезапуски скрипта Streamlit."""
+    from utils.embedder import get_embedder  # torch и transformers загружаются только здесь
+
+    # Движок инференса задается переменной окружения: torch, torch-int8 или onnx
+    embedder = get_embedder(backend=os.environ.get("E5_BACKEND", "torch"))
+    embedder.cache = EmbeddingCache(os.path.join(".cache", "embeddings.sqlite"))
+    return embedder
+
+
 st.title("Инструменты для таблиц")
 # Разделение интерфейса на вкладки
 tab1, tab2, tab3 = st.tabs(["Кластеризация комментариев", "Поиск по ноутбукам", "Агрегация результатов"])
@@ -151,9 +174,27 @@ with tab1:
     if uploaded_file is not None:
         file_path = uploaded_file
 
-        # Кластеризация в Streamlit
-        with st.spinner("Кластеризация данных выполняется, пожалуйста, подождите..."):
-            clustered_data = main(file_path, "Студент", "Проверяющий", "Индивидуальный комментарий", "Комментарий")
+        # Эмбеддинги и граф соседей считаются один раз на загрузку и хранятся в сессии;
+        # file_id меняется при каждой новой загрузке, даже если имя и размер файла совпадают
+        prepared_key = uploaded_file.file_id
+        if st.session_state.get("prepared_key") != prepared_key:
+            with st.spinner("Кластеризация данных выполняется, пожалуйста, подождите..."):
+                st.session_state["prepared_tasks"] = prepare_workbook(
+                    file_path, "Студент", "Проверяющий", "Индивидуальный комментарий", "Комментарий",
+                    embedder=load_embedder(), max_eps=MAX_EPS, n_jobs=CLUSTERING_JOBS, vocabulary_path=VOCABULARY_PATH,
+                )
+                st.session_state["prepared_key"] = prepared_key
+
+        # Перекластеризация с другими параметрами не запускает модель заново
+        col_eps, col_min_samples = st.columns(2)
+        with col_eps:
+            eps = st.slider("Порог близости (меньше — плотнее группы)", 5.0, float(MAX_EPS), 15.0, 0.5)
+        with col_min_samples:
+            min_samples = st.slider("Минимальное число соседей", 2, 10, 2)
+        clustered_data = cluster_workbook(
+            st.session_state["prepared_tasks"], eps=eps, min_samples=min_samples, embedder=load_embedder(),
+            ranking_engine=RANKING_ENGINE, ranking_jobs=RANKING_JOBS,
+        )
         
         if clustered_data is not None and not clustered_data.empty:
             st.success("Кластеризация завершена! Вы можете скачать результат.")
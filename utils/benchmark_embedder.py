@@ -0,0 +1,222 @@
+"""
+Бенчмарк пропускной способности E5Embedder.
+
+Запуск из корня проекта:
+    python -m utils.benchmark_embedder --batch-sizes 8 32 --threads 1 4 --backends torch torch-int8 \\
+        --cache-hit-ratios 0 0.5 --output bench.json
+
+Для каждой комбинации параметров запускается отдельный процесс, который загружает модель,
+прогревает ее и прогоняет синтетический корпус русскоязычных комментариев проверяющих.
+Результаты (тексты/с, токены/с, p50/p95 задержки батча, пиковый RSS) сохраняются в JSON,
+чтобы их можно было сравнивать между коммитами.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Словарь для синтетических комментариев проверяющих
+OPENINGS = ["", "", "*", "Хорошо, но ", "В целом верно, однако ", "Ошибка: ", "Замечание: ", "Минус балл, "]
+PHRASES = [
+    "нет выводов",
+    "не подписаны оси",
+    "не указаны единицы измерения",
+    "график не читается",
+    "неверно посчитан доверительный интервал",
+    "гипотеза сформулирована некорректно",
+    "не проверены условия применимости критерия",
+    "p-value интерпретировано неверно",
+    "отсутствует легенда на графике",
+    "код не запускается",
+    "не хватает пояснений к решению",
+    "выборка слишком мала для такого вывода",
+    "перепутаны нулевая и альтернативная гипотезы",
+    "нужно использовать поправку на множественное тестирование",
+    "оценка смещена, стоило обсудить это",
+    "не обоснован выбор распределения",
+    "гистограмма построена с неудачным числом бинов",
+    "результат верный, но оформление небрежное",
+]
+CONNECTORS = [", ", "; ", ". Кроме того, ", ", а также ", ". Также "]
+
+
+def make_corpus(n_texts: int, seed: int = 0) -> list[str]:
+    """
+    Генерирует синтетический корпус комментариев с реалистичным (лог-нормальным) распределением длин.
+    * n_texts : int
+        Количество комментариев.
+    * seed : int
+        Зерно генератора случайных чисел.
+
+    Возвращает:
+    * list[str] : Комментарии; около трети из них повторяются, как шаблонные комментарии в таблицах.
+    """
+    rng = np.random.default_rng(seed)
+    n_unique = max(1, int(n_texts * 0.7))
+    unique = []
+    for _ in range(n_unique):
+        # Большинство комментариев — одна-две фразы, изредка длинный разбор
+        n_phrases = int(np.clip(np.round(rng.lognormal(mean=0.3, sigma=0.8)), 1, 40))
+        parts = [PHRASES[k] for k in rng.integers(0, len(PHRASES), n_phrases)]
+        text = parts[0]
+        for part in parts[1:]:
+            text += CONNECTORS[rng.integers(0, len(CONNECTORS))] + part
+        text = OPENINGS[rng.integers(0, len(OPENINGS))] + text
+        unique.append(text[0].upper() + text[1:])
+    return [unique[k] for k in rng.integers(0, n_unique, n_texts)]
+
+
+def run_config(config: dict) -> dict:
+    """
+    Выполняет замер для одной комбинации параметров (вызывается в отдельном процессе).
+    * config : dict
+        Параметры: backend, batch_size, threads, max_length, cache_hit_ratio, n_texts, seed, repeats.
+
+    Возвращает:
+    * dict : Параметры и измеренные метрики.
+    """
+    import torch
+
+    from utils.embedder import E5Embedder
+    from utils.embedding_cache import EmbeddingCache
+
+    torch.set_num_threads(config["threads"])
+    texts = make_corpus(config["n_texts"], config["seed"])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        embedder = E5Embedder(backend=config["backend"], batch_size=config["batch_size"])
+        # Прогрев модели и пулов потоков
+        embedder.get_embeddings(texts[: config["batch_size"]], max_length=config["max_length"])
+
+        warm_path = os.path.join(tmp, "warm.sqlite")
+        if config["cache_hit_ratio"] > 0:
+            embedder.cache = EmbeddingCache(warm_path)
+            unique = list(dict.fromkeys(texts))
+            n_warm = int(round(len(unique) * config["cache_hit_ratio"]))
+            if n_warm:
+                embedder.get_embeddings(unique[:n_warm], max_length=config["max_length"])
+            # Закрытие соединения переносит журнал WAL в основной файл базы
+            embedder.cache.close()
+
+        latencies, durations = [], []
+        for repeat in range(config["repeats"]):
+            if config["cache_hit_ratio"] > 0:
+                # Каждый повтор начинается с одинаково прогретой копии кэша,
+                # иначе промахи первого повтора превратятся в попадания
+                run_path = os.path.join(tmp, f"run_{repeat}.sqlite")
+                shutil.copyfile(warm_path, run_path)
+                embedder.cache = EmbeddingCache(run_path)
+            start = last = time.perf_counter()
+            for _indices, _vectors in embedder.get_embeddings_iter(texts, max_length=config["max_length"]):
+                now = time.perf_counter()
+                latencies.append(now - last)
+                last = now
+            durations.append(time.perf_counter() - start)
+            if embedder.cache is not None:
+                embedder.cache.close()
+        plan = embedder.last_length_plan
+
+    lengths = np.array([len(ids) for ids in embedder.tokenizer([embedder.prefix + t for t in texts])["input_ids"]])
+    n_tokens = int(np.minimum(lengths, plan["max_length"]).sum())
+    duration = float(np.median(durations))
+    # ru_maxrss в Linux измеряется в килобайтах, в macOS — в байтах
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    return {
+        **config,
+        "seconds": duration,
+        "texts_per_s": len(texts) / duration,
+        "tokens_per_s": n_tokens / duration,
+        "batch_latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "batch_latency_p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "peak_rss_mb": peak_rss_mb,
+        "planned_max_length": plan["max_length"],
+        "truncated": plan["truncated"],
+    }
+
+
+def environment() -> dict:
+    """Собирает сведения об окружении для сравнения результатов между коммитами."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк пропускной способности E5Embedder")
+    parser.add_argument("--n-texts", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32])
+    parser.add_argument("--threads", type=int, nargs="+", default=[os.cpu_count() or 1])
+    parser.add_argument("--max-lengths", type=int, nargs="+", default=[0], help="0 — автоматический выбор")
+    parser.add_argument("--backends", nargs="+", default=["torch"])
+    parser.add_argument("--cache-hit-ratios", type=float, nargs="+", default=[0.0])
+    parser.add_argument("--output", default="-", help="Путь к JSON-файлу или '-' для stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    configs = [
+        {
+            "backend": backend,
+            "batch_size": batch_size,
+            "threads": threads,
+            "max_length": max_length or None,
+            "cache_hit_ratio": ratio,
+            "n_texts": args.n_texts,
+            "seed": args.seed,
+            "repeats": args.repeats,
+        }
+        for backend, batch_size, threads, max_length, ratio in itertools.product(
+            args.backends, args.batch_sizes, args.threads, args.max_lengths, args.cache_hit_ratios
+        )
+    ]
+
+    results = []
+    ctx = mp.get_context("spawn")
+    for config in configs:
+        # Отдельный процесс на каждую конфигурацию, чтобы пиковый RSS и потоки не влияли друг на друга
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_config, (config,))
+        print(
+            f"{result['backend']:10} bs={result['batch_size']:<3} threads={result['threads']:<2} "
+            f"max_length={result['planned_max_length']:<3} hit={result['cache_hit_ratio']:.2f}: "
+            f"{result['texts_per_s']:.1f} текстов/с, {result['tokens_per_s']:.0f} токенов/с, "
+            f"p95 {result['batch_latency_p95_ms']:.1f} мс, RSS {result['peak_rss_mb']:.0f} МБ",
+            file=sys.stderr,
+        )
+        results.append(result)
+
+    report = json.dumps({"environment": environment(), "results": results}, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
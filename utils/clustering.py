@@ -1,17 +1,242 @@
+import os
+import re
+import threading
 import typing as tp
+from functools import lru_cache
 
-import nltk
+import joblib
 import numpy as np
-from nltk.corpus import stopwords
+import scipy.sparse as sp
 from rake_nltk import Metric, Rake
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 
 from sklearn.cluster import DBSCAN
-from sklearn.preprocessing import StandardScaler
-from utils.embedder import E5Embedder
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import StandardScaler, normalize
+from sklearn.random_projection import SparseRandomProjection
+from utils.neighbors import ExactNeighbors, get_neighbor_provider
+from utils.resources import load_stopwords
+from utils.vocabulary import CourseVocabulary
 
-nltk.download("stopwords", quiet=True)
-nltk.download("punkt", quiet=True)
+# torch и transformers загружаются только при первом обращении к эмбеддеру: процессы-работники
+# prepare_workbook получают готовые эмбеддинги и модель не запускают
+if tp.TYPE_CHECKING:
+    from utils.embedder import E5Embedder
+
+# Наименьший радиус графа: DBSCAN не принимает eps=0
+MIN_RADIUS = 1e-9
+
+
+def eps_to_radius(eps: float, metric: str, mean_sq_norm: float, cosine_eps: tp.Optional[float] = None) -> float:
+    """
+    Переводит eps в радиус в метрике графа соседей.
+    * eps : float
+        Радиус в евклидовых единицах стандартизованных признаков.
+    * metric : str
+        "cosine" или "euclidean".
+    * mean_sq_norm : float
+        Средний квадрат нормы признаков.
+    * cosine_eps : float | None
+        Явный радиус в косинусном расстоянии (только для metric="cosine").
+
+    Возвращает:
+    * float : Радиус в метрике графа (для векторов одинаковой нормы |a - b|² = 2|a|²(1 - cos)).
+    """
+    if metric != "cosine":
+        radius = eps
+    elif cosine_eps is not None:
+        radius = cosine_eps
+    else:
+        radius = eps**2 / (2 * mean_sq_norm) if mean_sq_norm > 0 else 0.0
+    return max(radius, MIN_RADIUS)
+
+
+class FeatureModel:
+    """
+    Обученный конвейер признаков задачи: TF-IDF, его сжатие и стандартизация блоков TF-IDF и E5.
+    Позволяет перевести в то же пространство признаков комментарии, добавленные позже.
+    """
+
+    def __init__(self, vectorizer, reducer, tfidf_scaler, tfidf_weight: float, e5_scaler, normalize_e5: bool):
+        """
+        * vectorizer : TfidfVectorizer
+            Обученный векторизатор.
+        * reducer : TruncatedSVD | SparseRandomProjection | None
+            Обученное сжатие TF-IDF (None для крошечных корпусов).
+        * tfidf_scaler, e5_scaler : StandardScaler
+            Стандартизация блоков.
+        * tfidf_weight : float
+            Множитель блока TF-IDF.
+        * normalize_e5 : bool
+            L2-нормализовать эмбеддинги E5 перед стандартизацией.
+        """
+        self.vectorizer = vectorizer
+        self.reducer = reducer
+        self.tfidf_scaler = tfidf_scaler
+        self.tfidf_weight = tfidf_weight
+        self.e5_scaler = e5_scaler
+        self.normalize_e5 = normalize_e5
+
+    def transform(self, strings: tp.List[str], e5_embeddings: np.ndarray) -> np.ndarray:
+        """
+        Строит признаки для новых строк.
+        * strings : list[str]
+            Строки.
+        * e5_embeddings : np.ndarray
+            Их эмбеддинги E5.
+
+        Возвращает:
+        * np.ndarray : Матрица признаков в float32.
+        """
+        tfidf_matrix = self.vectorizer.transform(strings)
+        tfidf_block = self.reducer.transform(tfidf_matrix) if self.reducer is not None else tfidf_matrix.toarray()
+        tfidf_block = self.tfidf_scaler.transform(np.asarray(tfidf_block, dtype=np.float32)) * self.tfidf_weight
+
+        e5_block = np.asarray(e5_embeddings, dtype=np.float32)
+        if self.normalize_e5:
+            e5_block = normalize(e5_block)
+        e5_block = self.e5_scaler.transform(e5_block)
+
+        return np.hstack([tfidf_block, e5_block]).astype(np.float32, copy=False)
+
+
+class NeighborhoodSweep:
+    """
+    Граф соседей задачи, посчитанный один раз для максимального радиуса.
+    Метки DBSCAN для любого eps не больше максимального и любого min_samples извлекаются из него
+    без повторного вычисления эмбеддингов и расстояний.
+    """
+
+    def __init__(
+        self,
+        features: np.ndarray,
+        embeddings: np.ndarray,
+        metric: str = "cosine",
+        max_eps: float = 15.0,
+        max_cosine_eps: tp.Optional[float] = None,
+        inverse: tp.Optional[np.ndarray] = None,
+        weights: tp.Optional[np.ndarray] = None,
+        feature_model: tp.Optional[FeatureModel] = None,
+        keys: tp.Optional[tp.List[str]] = None,
+        neighbors: tp.Any = None,
+    ):
+        """
+        Строит граф соседей в радиусе max_eps.
+        * features : np.ndarray
+            Матрица признаков для DBSCAN размерности (U, K) — по одной строке на уникальный текст.
+        * embeddings : np.ndarray
+            Эмбеддинги E5 уникальных текстов размерности (U, D) (хранятся для ранжирования).
+        * metric : str
+            "cosine" или "euclidean".
+        * max_eps : float
+            Наибольший eps (в евклидовых единицах стандартизованных признаков), который понадобится.
+        * max_cosine_eps : float | None
+            Наибольший радиус в косинусном расстоянии; если не задан, пересчитывается из max_eps.
+        * inverse : np.ndarray | None
+            Номер уникального текста для каждой исходной строки (длина N); по умолчанию тексты не схлопывались.
+        * weights : np.ndarray | None
+            Кратность каждого уникального текста, передается в DBSCAN как sample_weight.
+        * feature_model : FeatureModel | None
+            Конвейер, которым получены признаки (нужен для сохранения модели кластеров).
+        * keys : list[str] | None
+            Нормализованные уникальные тексты.
+        * neighbors : ExactNeighbors | ApproximateNeighbors | None
+            Поставщик соседей для построения графа (по умолчанию точный перебор).
+        """
+        self.unique_embeddings = embeddings
+        self.inverse = inverse if inverse is not None else np.arange(len(features))
+        self.weights = weights
+        self.features = features
+        self.feature_model = feature_model
+        self.keys = keys
+        self.metric = metric
+        # Средний квадрат нормы признаков — для перевода евклидова eps в косинусный
+        self.mean_sq_norm = float(np.average(np.einsum("ij,ij->i", features, features), weights=weights))
+        self.max_radius = self.radius(max_eps, max_cosine_eps)
+        self.neighbors = neighbors if neighbors is not None else ExactNeighbors()
+        self.graph = self.neighbors.radius_graph(features, self.max_radius, metric)
+
+    @property
+    def is_degenerate(self) -> bool:
+        """Расстояния между текстами не определены: уникальный текст один или все признаки нулевые."""
+        return len(self.features) == 1 or self.mean_sq_norm <= 0
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Эмбеддинги E5 для всех исходных строк размерности (N, D)."""
+        return self.unique_embeddings[self.inverse]
+
+    def radius(self, eps: float, cosine_eps: tp.Optional[float] = None) -> float:
+        """
+        Переводит eps в радиус в метрике графа (см. eps_to_radius).
+        * eps : float
+            Радиус в евклидовых единицах стандартизованных признаков.
+        * cosine_eps : float | None
+            Явный радиус в косинусном расстоянии (только для metric="cosine").
+
+        Возвращает:
+        * float : Радиус в метрике графа.
+        """
+        return eps_to_radius(eps, self.metric, self.mean_sq_norm, cosine_eps)
+
+    def labels(
+        self,
+        eps: float = 15.0,
+        min_samples: int = 2,
+        cosine_eps: tp.Optional[float] = None,
+        sample_weight: tp.Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Извлекает метки DBSCAN из готового графа соседей.
+        * eps : float
+            Максимальное расстояние между точками (не больше того, для которого построен граф).
+        * min_samples : int
+            Минимальное количество точек для образования кластера.
+        * cosine_eps : float | None
+            Явный радиус в косинусном расстоянии.
+        * sample_weight : np.ndarray | None
+            Веса уникальных точек для DBSCAN; по умолчанию их кратности.
+
+        Возвращает:
+        * np.ndarray : Метки кластеров для всех исходных строк (-1 — шум).
+        """
+        labels, _ = self.fit_unique(eps, min_samples, cosine_eps=cosine_eps, sample_weight=sample_weight)
+        # Метки уникальных текстов разворачиваются на все исходные строки
+        return labels[self.inverse]
+
+    def fit_unique(
+        self,
+        eps: float = 15.0,
+        min_samples: int = 2,
+        cosine_eps: tp.Optional[float] = None,
+        sample_weight: tp.Optional[np.ndarray] = None,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """
+        Запускает DBSCAN по готовому графу для уникальных текстов.
+        Параметры — как у labels().
+
+        Возвращает:
+        * np.ndarray : Метки уникальных текстов.
+        * np.ndarray : Маска основных (core) точек.
+        """
+        radius = self.radius(eps, cosine_eps)
+        if radius > self.max_radius * (1 + 1e-9):
+            raise ValueError(f"eps больше радиуса, для которого построен граф соседей ({radius} > {self.max_radius})")
+        if sample_weight is None:
+            sample_weight = self.weights
+        if self.is_degenerate:
+            # Все уникальные тексты совпадают по признакам (например, в задаче один и тот же комментарий):
+            # расстояния не определены, поэтому это один кластер, если точек хватает, иначе шум
+            n_unique = len(self.features)
+            total = n_unique if sample_weight is None else float(np.sum(sample_weight))
+            is_cluster = total >= min_samples
+            return np.full(n_unique, 0 if is_cluster else -1), np.full(n_unique, is_cluster)
+        # DBSCAN сам отбрасывает ребра длиннее radius; копия нужна, так как он дописывает диагональ в граф
+        clustering = DBSCAN(eps=radius, min_samples=min_samples, metric="precomputed")
+        clustering.fit(self.graph.copy(), sample_weight=sample_weight)
+        core = np.zeros(len(clustering.labels_), dtype=bool)
+        core[clustering.core_sample_indices_] = True
+        return clustering.labels_, core
 
 
 class Clusterer:
@@ -19,10 +244,77 @@ class Clusterer:
     Класс для кластеризации текстов и выделения ключевых фраз.
     """
 
-    def __init__(self):
-        """Инициализирует эмбеддер и необходимые стоп-слова."""
+    def __init__(
+        self,
+        e5_embedder: tp.Optional["E5Embedder"] = None,
+        embedding_dtype: tp.Any = np.float32,
+        tfidf_components: int = 64,
+        tfidf_reducer: str = "svd",
+        normalize_e5: bool = False,
+        random_state: int = 0,
+        metric: str = "cosine",
+        deduplicate: bool = True,
+        vocabulary_path: tp.Optional[str] = None,
+        vocabulary_drift: float = 0.1,
+        neighbors: tp.Any = "exact",
+    ):
+        """
+        Инициализирует эмбеддер и необходимые стоп-слова.
+        * e5_embedder : E5Embedder | None
+            Эмбеддер; если не передан, при первом обращении берется общий для процесса экземпляр из get_embedder().
+        * embedding_dtype : np.dtype
+            Тип хранимых эмбеддингов E5; np.float16 вдвое уменьшает память (по умолчанию np.float32).
+        * tfidf_components : int
+            Размерность, до которой сжимается разреженная матрица TF-IDF (по умолчанию 64).
+        * tfidf_reducer : str
+            Способ сжатия TF-IDF: "svd" (TruncatedSVD) или "random" (разреженная случайная проекция).
+        * normalize_e5 : bool
+            L2-нормализовать эмбеддинги E5 перед стандартизацией (по умолчанию False).
+        * random_state : int
+            Зерно для SVD и случайной проекции.
+        * metric : str
+            Метрика DBSCAN: "cosine" (разреженный граф соседей в радиусе по L2-нормализованным признакам)
+            или "euclidean" (прямой перебор по стандартизованным признакам). По умолчанию "cosine".
+        * deduplicate : bool
+            Схлопывать почти одинаковые комментарии перед эмбеддингом и кластеризацией (по умолчанию True).
+        * vocabulary_path : str | None
+            Путь к сохраненному словарю TF-IDF курса (см. CourseVocabulary); если не задан,
+            TF-IDF обучается заново на комментариях каждой задачи.
+        * vocabulary_drift : float
+            Порог дрейфа словаря, при превышении которого словарь курса переобучается (по умолчанию 0.1).
+        * neighbors : str | ExactNeighbors | ApproximateNeighbors
+            Поставщик соседей для графа DBSCAN: "exact" (точный перебор), "ann" (приближенный индекс NN-descent
+            для корпусов в десятки тысяч комментариев) или готовый объект (по умолчанию "exact").
+        """
+        if tfidf_reducer not in ("svd", "random"):
+            raise ValueError(f"Неизвестный способ сжатия TF-IDF: {tfidf_reducer!r}")
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError(f"Неизвестная метрика: {metric!r}")
         self.stopwords_ru = self._prepare_stopwords()
-        self.e5_embedder = E5Embedder() 
+        self._e5_embedder = e5_embedder
+        self.embedding_dtype = embedding_dtype
+        self.tfidf_components = tfidf_components
+        self.tfidf_reducer = tfidf_reducer
+        self.normalize_e5 = normalize_e5
+        self.random_state = random_state
+        self.metric = metric
+        self.deduplicate = deduplicate
+        self.neighbors = get_neighbor_provider(neighbors) if isinstance(neighbors, str) else neighbors
+        self.vocabulary = (
+            CourseVocabulary(vocabulary_path, self.stopwords_ru, drift_threshold=vocabulary_drift)
+            if vocabulary_path is not None
+            else None
+        )
+
+    @property
+    def e5_embedder(self) -> "E5Embedder":
+        """Эмбеддер; модель загружается только тогда, когда эмбеддинги действительно нужно посчитать."""
+        if self._e5_embedder is None:
+            from utils.embedder import get_embedder
+
+            self._e5_embedder = get_embedder()
+        return self._e5_embedder
+
     @staticmethod
     def _prepare_stopwords() -> list[str]:
         """
@@ -30,7 +322,7 @@ class Clusterer:
         Возвращает:
         * list[str] : Список стоп-слов.
         """
-        stopwords_ru = stopwords.words("russian")
+        stopwords_ru = list(load_stopwords("russian"))
         additional_stopwords = [
             "который",
             "затем",
@@ -59,18 +351,237 @@ class Clusterer:
         Возвращает:
         * list[str] : Список ключевых фраз.
         """
-        r = Rake(
-            stopwords=self.stopwords_ru,
-            punctuations=",.()!?",
-            language="russian",
-            min_length=1,
-            ranking_metric=Metric.WORD_FREQUENCY,
-            include_repeated_phrases=False,
+        r = _rake_extractor()
+        # Rake хранит состояние последнего текста, поэтому общий экземпляр используется под блокировкой
+        with _rake_lock:
+            r.extract_keywords_from_text(text)
+            return r.get_ranked_phrases()
+
+    def update_vocabulary(self, strings: tp.List[str], force: bool = False) -> bool:
+        """
+        Дообучает словарь TF-IDF курса, если он еще не обучен, если force=True или если дрейф словаря превышает порог.
+        * strings : list[str]
+            Комментарии курса (например, всех задач книги).
+        * force : bool
+            Переобучить словарь в любом случае.
+
+        Возвращает:
+        * bool : Был ли словарь переобучен.
+        """
+        if self.vocabulary is None:
+            raise ValueError("Словарь курса не задан: передайте vocabulary_path")
+        return self.vocabulary.update([s for s in self._clean_strings(strings) if s], force=force)
+
+    def _fit_features(self, tfidf_matrix, vectorizer, e5_embeddings: np.ndarray) -> tp.Tuple[FeatureModel, np.ndarray]:
+        """
+        Обучает конвейер признаков и строит матрицу признаков для DBSCAN.
+        Разреженная матрица TF-IDF сжимается до небольшого плотного блока, не переводясь в плотный вид.
+        Каждый блок стандартизуется отдельно, а блок TF-IDF масштабируется так, чтобы его вклад
+        в евклидово расстояние был таким же, как у V стандартизованных столбцов исходной матрицы.
+        Благодаря этому прежний порог eps сохраняет смысл.
+        * tfidf_matrix : scipy.sparse.csr_matrix
+            Разреженная матрица TF-IDF размерности (N, V).
+        * vectorizer : TfidfVectorizer
+            Векторизатор, которым получена матрица.
+        * e5_embeddings : np.ndarray
+            Эмбеддинги E5 размерности (N, D).
+
+        Возвращает:
+        * FeatureModel : Обученный конвейер признаков.
+        * np.ndarray : Матрица признаков размерности (N, K + D) в float32, K <= tfidf_components.
+        """
+        n_samples = tfidf_matrix.shape[0]
+        # Для словаря курса учитываются только слова, встречающиеся в задаче: остальные столбцы нулевые
+        n_features = int((tfidf_matrix.getnnz(axis=0) > 0).sum())
+        n_components = min(self.tfidf_components, n_features - 1, n_samples - 1)
+        if n_components < 1:
+            # Слишком маленький корпус: матрица и так крошечная
+            reducer, tfidf_block = None, tfidf_matrix.toarray()
+        else:
+            if self.tfidf_reducer == "svd":
+                reducer = TruncatedSVD(n_components=n_components, random_state=self.random_state)
+            else:
+                # Без dense_output проекция разреженной матрицы остается разреженной и не стандартизуется
+                reducer = SparseRandomProjection(
+                    n_components=n_components, dense_output=True, random_state=self.random_state
+                )
+            tfidf_block = reducer.fit_transform(tfidf_matrix)
+
+        tfidf_scaler = StandardScaler()
+        tfidf_block = tfidf_scaler.fit_transform(np.asarray(tfidf_block, dtype=np.float32))
+        tfidf_weight = np.sqrt(n_features / tfidf_block.shape[1]) if tfidf_block.shape[1] else 1.0
+        tfidf_block *= tfidf_weight
+
+        e5_block = np.asarray(e5_embeddings, dtype=np.float32)
+        if self.normalize_e5:
+            e5_block = normalize(e5_block)
+        e5_scaler = StandardScaler()
+        e5_block = e5_scaler.fit_transform(e5_block)
+
+        feature_model = FeatureModel(vectorizer, reducer, tfidf_scaler, tfidf_weight, e5_scaler, self.normalize_e5)
+        return feature_model, np.hstack([tfidf_block, e5_block]).astype(np.float32, copy=False)
+
+    @staticmethod
+    def normalize_comment(text: str) -> str:
+        """
+        Приводит комментарий к виду для поиска дубликатов: нижний регистр, без префикса "*"
+        общих комментариев, без повторяющихся пробелов и завершающей пунктуации.
+        * text : str
+            Комментарий.
+
+        Возвращает:
+        * str : Нормализованный комментарий.
+        """
+        text = " ".join(text.lower().split())
+        return re.sub(r"[\s.,;:!?…]+$", "", text.lstrip("*").strip())
+
+    @staticmethod
+    def _clean_strings(strings: tp.List[tp.Any]) -> tp.List[str]:
+        """Заменяет np.nan и прочие нестроковые значения на пустые строки."""
+        return [str(s) if isinstance(s, str) or (isinstance(s, float) and not np.isnan(s)) else "" for s in strings]
+
+    def _deduplicate(self, strings: tp.List[str]) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Схлопывает дубликаты с точностью до normalize_comment.
+        * strings : list[str]
+            Комментарии.
+
+        Возвращает:
+        * np.ndarray : Индексы уникальных представителей (первое вхождение каждого комментария).
+        * np.ndarray : Номер представителя для каждой исходной строки.
+        * np.ndarray : Кратность каждого представителя.
+        """
+        if not self.deduplicate:
+            return np.arange(len(strings)), np.arange(len(strings)), np.ones(len(strings), dtype=int)
+        first_index = {}
+        representatives, inverse = [], np.empty(len(strings), dtype=int)
+        for i, text in enumerate(strings):
+            key = self.normalize_comment(text)
+            if key not in first_index:
+                first_index[key] = len(representatives)
+                representatives.append(i)
+            inverse[i] = first_index[key]
+        return np.array(representatives, dtype=int), inverse, np.bincount(inverse, minlength=len(representatives))
+
+    def embed_many(self, string_lists: tp.List[tp.List[tp.Any]]) -> tp.List[np.ndarray]:
+        """
+        Считает эмбеддинги E5 для нескольких списков строк (например, всех задач книги) за один проход модели.
+        Результат для каждого списка совпадает с тем, что посчитал бы prepare() для него отдельно:
+        дубликаты схлопываются так же, а списки с разным max_length обрабатываются раздельно.
+        * string_lists : list[list[tp.Any]]
+            Списки строк.
+
+        Возвращает:
+        * list[np.ndarray] : Эмбеддинги размерности (N_i, D) для каждого списка.
+        """
+        # Уникальные тексты, сгруппированные по max_length: текст -> строка в общей матрице группы
+        groups: tp.Dict[int, tp.Dict[str, int]] = {}
+        # Токенизированные тексты групп (в порядке строк), чтобы модель не токенизировала их повторно
+        group_features: tp.Dict[int, list] = {}
+        plans = []
+        for strings in string_lists:
+            strings = self._clean_strings(strings)
+            if not strings:
+                plans.append(None)
+                continue
+            representatives, inverse, _ = self._deduplicate(strings)
+            texts = [strings[i] for i in representatives]
+            features = self.e5_embedder.tokenize(texts)
+            max_length = self.e5_embedder.plan_max_length(texts, features)
+            group = groups.setdefault(max_length, {})
+            rows = np.empty(len(texts), dtype=int)
+            for j, (text, feature) in enumerate(zip(texts, features)):
+                if text not in group:
+                    group[text] = len(group)
+                    group_features.setdefault(max_length, []).append(feature)
+                rows[j] = group[text]
+            # Эмбеддинг исходной строки i — строка rows[inverse[i]] матрицы группы
+            plans.append((max_length, rows[inverse]))
+
+        group_embeddings = {
+            max_length: self.e5_embedder.get_embeddings(
+                list(group), max_length=max_length, dtype=self.embedding_dtype, features=group_features[max_length]
+            )
+            for max_length, group in groups.items()
+        }
+        return [
+            np.empty((0, self.e5_embedder.hidden_size), dtype=self.embedding_dtype)
+            if plan is None
+            else group_embeddings[plan[0]][plan[1]]
+            for plan in plans
+        ]
+
+    def prepare(
+        self,
+        strings: tp.List[tp.Any],
+        max_eps: float = 15.0,
+        max_cosine_eps: tp.Optional[float] = None,
+        e5_embeddings: tp.Optional[np.ndarray] = None,
+    ) -> NeighborhoodSweep:
+        """
+        Вычисляет признаки и граф соседей задачи один раз, чтобы затем быстро перебирать eps и min_samples.
+        * strings : list[tp.Any]
+            Список строк для кластеризации. Может включать строки или np.nan.
+        * max_eps : float
+            Наибольший eps, который понадобится при извлечении меток (по умолчанию 15.0).
+        * max_cosine_eps : float | None
+            Наибольший радиус в косинусном расстоянии для metric="cosine".
+        * e5_embeddings : np.ndarray | None
+            Готовые эмбеддинги E5 для всех строк (например, из embed_many); если не переданы, вычисляются.
+
+        Возвращает:
+        * NeighborhoodSweep : Граф соседей и эмбеддинги E5.
+        """
+        # Предобработка строк: замена np.nan на пустые строки
+        strings = self._clean_strings(strings)
+
+        # Эмбеддинги и кластеризация считаются только для уникальных комментариев
+        representatives, inverse, weights = self._deduplicate(strings)
+        strings = [strings[i] for i in representatives]
+        
+        if self.vocabulary is not None:
+            # Словарь курса только применяется; обучается он при первом использовании или в update_vocabulary
+            if not self.vocabulary.is_fitted:
+                self.vocabulary.fit(strings)
+            vectorizer = self.vocabulary.vectorizer
+            tfidf_matrix = self.vocabulary.transform(strings)
+        else:
+            # Инициализация TF-IDF векторизатора
+            vectorizer = TfidfVectorizer(stop_words=self.stopwords_ru, max_features=1000)
+
+            # Преобразование строк в матрицу признаков с использованием TF-IDF
+            tfidf_matrix = vectorizer.fit_transform(strings)
+        
+        # Получение эмбеддингов с помощью e5_embedder (предположительно более сложный метод эмбеддинга)
+        if e5_embeddings is None:
+            e5_embeddings = self.e5_embedder.get_embeddings(strings, dtype=self.embedding_dtype)
+        else:
+            e5_embeddings = e5_embeddings[representatives]
+        
+        # Объединяем сжатый TF-IDF и эмбеддинги e5_embedder без перевода TF-IDF в плотный вид
+        feature_model, scaled_embeddings = self._fit_features(tfidf_matrix, vectorizer, e5_embeddings)
+
+        return NeighborhoodSweep(
+            scaled_embeddings,
+            e5_embeddings,
+            metric=self.metric,
+            max_eps=max_eps,
+            max_cosine_eps=max_cosine_eps,
+            inverse=inverse,
+            weights=weights,
+            feature_model=feature_model,
+            keys=[self.normalize_comment(text) for text in strings],
+            neighbors=self.neighbors,
         )
-        r.extract_keywords_from_text(text)
-        return r.get_ranked_phrases()
 
-    def cluster(self, strings: tp.List[tp.Any], eps: float = 15.0, min_samples: int = 2) -> np.ndarray:
+    def cluster(
+        self,
+        strings: tp.List[tp.Any],
+        eps: float = 15.0,
+        min_samples: int = 2,
+        return_embeddings: bool = False,
+        cosine_eps: tp.Optional[float] = None,
+    ) -> tp.Union[np.ndarray, tp.Tuple[np.ndarray, np.ndarray]]:
         """
         Кластеризует строки и возвращает номера кластеров.
         * strings : list[tp.Any]
@@ -79,34 +590,255 @@ class Clusterer:
             Максимальное расстояние между точками для создания кластера (по умолчанию 15.0).
         * min_samples : int
             Минимальное количество точек для образования кластера (по умолчанию 2).
+        * return_embeddings : bool
+            Вернуть также эмбеддинги E5, чтобы переиспользовать их при ранжировании (по умолчанию False).
+        * cosine_eps : float | None
+            Радиус в косинусном расстоянии для metric="cosine"; если не задан, пересчитывается из eps
+            (для векторов одинаковой нормы |a - b|² = 2|a|²(1 - cos)).
 
         Возвращает:
         * np.ndarray : Массив меток кластеров для каждой строки.
+        * np.ndarray : Эмбеддинги E5 размерности (N, D), если return_embeddings=True.
         """
-        # Предобработка строк: замена np.nan на пустые строки
-        strings = [str(s) if isinstance(s, str) or (isinstance(s, float) and not np.isnan(s)) else "" for s in strings]
-        
-        # Инициализация TF-IDF векторизатора
-        vectorizer = TfidfVectorizer(stop_words=self.stopwords_ru, max_features=1000)
-        
-        # Преобразование строк в матрицу признаков с использованием TF-IDF
-        tfidf_matrix = vectorizer.fit_transform(strings)
-        
-        # Получение эмбеддингов на основе TF-IDF
-        tfidf_embeddings = tfidf_matrix.toarray()
-        
-        # Получение эмбеддингов с помощью e5_embedder (предположительно более сложный метод эмбеддинга)
-        e5_embeddings = self.e5_embedder.get_embeddings(strings)
-        
-        # Объединяем эмбеддинги TF-IDF и e5_embedder
-        combined_embeddings = np.concatenate([tfidf_embeddings, e5_embeddings], axis=1)
-        
-        # Нормализация объединенных эмбеддингов
-        scaled_embeddings = StandardScaler().fit_transform(combined_embeddings)
+        if self.vocabulary is not None:
+            self.update_vocabulary(self._clean_strings(strings))
+        sweep = self.prepare(strings, max_eps=eps, max_cosine_eps=cosine_eps)
 
         # Кластеризация методом DBSCAN
-        clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(scaled_embeddings)
+        labels = sweep.labels(eps, min_samples, cosine_eps=cosine_eps)
         # Проверка на наличие кластеров
-        if len(np.unique(clustering.labels_)) == 1 and -1 in clustering.labels_:
-            return np.array([])  # Возвращаем пустой массив, если кластеров нет
-        return clustering.labels_
+        if len(np.unique(labels)) == 1 and -1 in labels:
+            labels = np.array([])  # Возвращаем пустой массив, если кластеров нет
+        if return_embeddings:
+            return labels, sweep.embeddings
+        return labels
+
+    def _fit_model(
+        self, strings: tp.List[str], eps: float, min_samples: int, cosine_eps: tp.Optional[float]
+    ) -> tp.Tuple[dict, np.ndarray]:
+        """
+        Кластеризует строки с нуля и собирает сохраняемую модель кластеров.
+
+        Возвращает:
+        * dict : Модель кластеров (см. cluster_incremental).
+        * np.ndarray : Номер записи модели для каждой строки.
+        """
+        sweep = self.prepare(strings, max_eps=eps, max_cosine_eps=cosine_eps)
+        labels, core = sweep.fit_unique(eps, min_samples, cosine_eps=cosine_eps)
+        counts = sweep.weights if sweep.weights is not None else np.ones(len(labels), dtype=int)
+        model = {
+            "params": {"eps": eps, "min_samples": min_samples, "cosine_eps": cosine_eps, "metric": self.metric},
+            "feature_model": sweep.feature_model,
+            "mean_sq_norm": sweep.mean_sq_norm,
+            "keys": sweep.keys,
+            "features": sweep.features,
+            "embeddings": sweep.unique_embeddings,
+            "labels": labels,
+            "core": core,
+            "counts": counts,
+        }
+        return model, sweep.inverse
+
+    def cluster_incremental(
+        self,
+        strings: tp.List[tp.Any],
+        model_path: str,
+        eps: float = 15.0,
+        min_samples: int = 2,
+        cosine_eps: tp.Optional[float] = None,
+    ) -> tp.Tuple[np.ndarray, np.ndarray, tp.Optional[TfidfVectorizer]]:
+        """
+        Кластеризует строки, дополняя сохраненную модель кластеров задачи.
+        Если модели нет (или она обучена с другими параметрами), строки кластеризуются с нуля.
+        Иначе уже встречавшиеся комментарии сохраняют свои номера кластеров, новые присоединяются
+        к кластеру ближайшей основной точки в радиусе eps, а DBSCAN заново запускается только
+        по оставшемуся шуму; новые кластеры получают номера после уже существующих.
+        Модель (признаки, эмбеддинги, метки и основные точки уникальных комментариев) сохраняется в model_path.
+        * strings : list[tp.Any]
+            Список строк для кластеризации. Может включать строки или np.nan.
+        * model_path : str
+            Путь к файлу модели кластеров задачи.
+        * eps : float
+            Максимальное расстояние между точками для создания кластера (по умолчанию 15.0).
+        * min_samples : int
+            Минимальное количество точек для образования кластера (по умолчанию 2).
+        * cosine_eps : float | None
+            Радиус в косинусном расстоянии для metric="cosine".
+
+        Возвращает:
+        * np.ndarray : Метки кластеров для каждой строки (-1 — шум).
+        * np.ndarray : Эмбеддинги E5 размерности (N, D).
+        * TfidfVectorizer | None : Векторизатор модели (для подписей кластеров); None для пустого списка.
+        """
+        strings = self._clean_strings(strings)
+        if not strings:
+            return np.array([], dtype=int), np.empty((0, 0), dtype=self.embedding_dtype), None
+        params = {"eps": eps, "min_samples": min_samples, "cosine_eps": cosine_eps, "metric": self.metric}
+        model = joblib.load(model_path) if os.path.exists(model_path) else None
+        if model is not None and model["params"] != params:
+            print(f"Параметры кластеризации изменились, модель {model_path} обучается заново")
+            model = None
+        elif model is not None and (len(model["keys"]) == 1 or model["mean_sq_norm"] <= 0):
+            # Модель из одинаковых комментариев не задает масштаб расстояний, к ней нельзя присоединять новые
+            model = None
+
+        if model is None:
+            model, rows = self._fit_model(strings, eps, min_samples, cosine_eps)
+        else:
+            rows = self._extend_model(model, strings, eps, min_samples, cosine_eps)
+
+        os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+        # Запись через временный файл, чтобы прерванный запуск не испортил модель
+        joblib.dump(model, model_path + ".tmp")
+        os.replace(model_path + ".tmp", model_path)
+        return model["labels"][rows], model["embeddings"][rows], model["feature_model"].vectorizer
+
+    def _extend_model(
+        self, model: dict, strings: tp.List[str], eps: float, min_samples: int, cosine_eps: tp.Optional[float]
+    ) -> np.ndarray:
+        """
+        Дополняет модель кластеров новыми комментариями (изменяет model на месте).
+
+        Возвращает:
+        * np.ndarray : Номер записи модели для каждой строки.
+        """
+        representatives, inverse, weights = self._deduplicate(strings)
+        key_index = {key: i for i, key in enumerate(model["keys"])}
+        texts = [strings[i] for i in representatives]
+        keys = [self.normalize_comment(text) for text in texts]
+        known = np.array([key in key_index for key in keys], dtype=bool)
+        new = np.flatnonzero(~known)
+
+        n_old = len(model["keys"])
+        rows = np.empty(len(texts), dtype=int)
+        rows[known] = [key_index[keys[i]] for i in np.flatnonzero(known)]
+        rows[new] = n_old + np.arange(len(new))
+
+        radius = eps_to_radius(eps, model["params"]["metric"], model["mean_sq_norm"], cosine_eps)
+        if len(new):
+            new_texts = [texts[i] for i in new]
+            embeddings = self.e5_embedder.get_embeddings(new_texts, dtype=model["embeddings"].dtype)
+            features = model["feature_model"].transform(new_texts, embeddings)
+
+            # Новый комментарий присоединяется к кластеру ближайшей основной точки в радиусе eps
+            labels = np.full(len(new), -1, dtype=model["labels"].dtype)
+            core_rows = np.flatnonzero(model["core"])
+            if len(core_rows):
+                nearest, distances = self.neighbors.nearest(
+                    features, model["features"][core_rows], model["params"]["metric"]
+                )
+                assigned = distances <= radius
+                labels[assigned] = model["labels"][core_rows[nearest[assigned]]]
+            print(f"Новых комментариев: {len(new)}, присоединено к кластерам: {int((labels >= 0).sum())}")
+
+            model["keys"] = model["keys"] + [keys[i] for i in new]
+            model["features"] = np.vstack([model["features"], features])
+            model["embeddings"] = np.vstack([model["embeddings"], embeddings])
+            model["labels"] = np.concatenate([model["labels"], labels])
+            model["core"] = np.concatenate([model["core"], np.zeros(len(new), dtype=bool)])
+
+        # Кратности текущего запуска; комментарии, удаленные из таблицы, остаются в модели с нулевым весом
+        counts = np.zeros(len(model["keys"]), dtype=int)
+        np.add.at(counts, rows, weights)
+        model["counts"] = counts
+
+        # DBSCAN заново только по шуму, который есть в текущей таблице
+        leftover = np.flatnonzero((model["labels"] == -1) & (counts > 0))
+        if len(leftover):
+            graph = self.neighbors.radius_graph(model["features"][leftover], radius, model["params"]["metric"])
+            clustering = DBSCAN(eps=radius, min_samples=min_samples, metric="precomputed")
+            clustering.fit(graph, sample_weight=counts[leftover])
+            found = clustering.labels_ >= 0
+            offset = max(int(model["labels"].max()) + 1, 0)
+            model["labels"][leftover[found]] = clustering.labels_[found] + offset
+            model["core"][leftover[clustering.core_sample_indices_]] = True
+
+        return rows[inverse]
+
+
+_rake_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _rake_extractor() -> Rake:
+    """Создает извлекатель ключевых фраз RAKE один раз за процесс."""
+    return Rake(
+        stopwords=Clusterer._prepare_stopwords(),
+        punctuations=",.()!?",
+        language="russian",
+        min_length=1,
+        ranking_metric=Metric.WORD_FREQUENCY,
+        include_repeated_phrases=False,
+    )
+
+
+def label_clusters(
+    strings: tp.List[str],
+    labels: np.ndarray,
+    vectorizer: tp.Optional[TfidfVectorizer] = None,
+    top_n: int = 3,
+    refine: bool = False,
+) -> tp.Dict[int, str]:
+    """
+    Подбирает короткие подписи всем кластерам задачи за один проход class-based TF-IDF:
+    комментарии кластера считаются одним документом, а слова взвешиваются по тому,
+    насколько они характерны для кластера относительно остальных.
+    * strings : list[str]
+        Комментарии.
+    * labels : np.ndarray
+        Метки кластеров (-1 — шум, не подписывается).
+    * vectorizer : TfidfVectorizer | None
+        Уже обученный векторизатор задачи или курса; если не передан, обучается на комментариях кластеров.
+    * top_n : int
+        Число слов в подписи (по умолчанию 3).
+    * refine : bool
+        Заменять подпись ключевой фразой RAKE, содержащей главное слово кластера (по умолчанию False).
+
+    Возвращает:
+    * dict[int, str] : Подпись для каждой метки кластера.
+    """
+    labels = np.asarray(labels)
+    mask = labels >= 0
+    if not mask.any():
+        return {}
+    strings = [text for text, keep in zip(strings, mask) if keep]
+    cluster_ids, rows = np.unique(labels[mask], return_inverse=True)
+
+    if vectorizer is None:
+        try:
+            vectorizer = TfidfVectorizer(stop_words=Clusterer._prepare_stopwords(), max_features=1000).fit(strings)
+        except ValueError:
+            # В кластерах только стоп-слова и знаки препинания: подписывать нечем
+            return {int(cluster_id): "" for cluster_id in cluster_ids}
+    # Частоты слов по словарю уже обученного векторизатора, без повторного обучения
+    counter = CountVectorizer(vocabulary=vectorizer.vocabulary_, analyzer=vectorizer.build_analyzer())
+    counts = counter.transform(strings)
+    membership = sp.csr_matrix(
+        (np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(cluster_ids), len(rows))
+    )
+    class_counts = np.asarray((membership @ counts).todense(), dtype=np.float64)
+
+    # c-TF-IDF: частота слова в кластере * log(1 + среднее число слов в кластере / частота слова во всех кластерах)
+    tf = class_counts / np.maximum(class_counts.sum(axis=1, keepdims=True), 1.0)
+    idf = np.log1p(class_counts.sum() / len(cluster_ids) / np.maximum(class_counts.sum(axis=0), 1.0))
+    scores = tf * idf
+    top = np.argsort(-scores, axis=1)[:, :top_n]
+
+    terms = np.empty(len(vectorizer.vocabulary_), dtype=object)
+    for term, column in vectorizer.vocabulary_.items():
+        terms[column] = term
+
+    names = {}
+    for k, cluster_id in enumerate(cluster_ids):
+        words = [terms[j] for j in top[k] if scores[k, j] > 0]
+        name = ", ".join(words)
+        if refine and words:
+            texts = dict.fromkeys(strings[i] for i in np.flatnonzero(rows == k))
+            r = _rake_extractor()
+            with _rake_lock:
+                r.extract_keywords_from_text(". ".join(texts))
+                phrases = r.get_ranked_phrases()
+            # Первая короткая фраза с главным словом кластера
+            name = next((p for p in phrases if words[0] in p.split() and len(p.split()) <= 4), name)
+        names[int(cluster_id)] = name
+    return names
@@ -1,16 +1,25 @@
 # Основные библиотеки
-import streamlit as st
 import pandas as pd
 import numpy as np
 import re
 import io
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 from openpyxl.styles import Font, PatternFill
 
-# Импорты пользовательских модулей
-from utils.clustering import Clusterer  # Кластеризация данных
-from utils.ranking import Ranker  # Ранжирование данных
+# Тяжелые модули (torch, transformers, umap, nltk, sklearn) импортируются лениво внутри
+# clustering() и main(), чтобы не замедлять запуск вкладок, которым они не нужны
+if TYPE_CHECKING:
+    from utils.clustering import Clusterer
+    from utils.ranking import Ranker
 
 
+# Наибольший eps, доступный для перекластеризации без пересчета графа соседей
+MAX_EPS = 25
+
 pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
 
@@ -161,9 +170,8 @@ def creating_dictionary(df, base_columns_i, base_columns_o, cell_coordinates):
     
     return experts_comments_dict
 
-def clustering(experts_comments_dict: dict[str, any]) -> pd.DataFrame:
-    '''Кластеризует комментарии экспертов и возвращает информацию о кластерах'''
-    clusterer = Clusterer()  # Создаем объект без параметров
+def collect_comments(experts_comments_dict: dict[str, any]) -> dict:
+    '''Собирает комментарии задачи и их ячейки, студентов и проверяющих в параллельные списки'''
     comments, keys, students, reviewers = [], [], [], []
 
     for student, data in experts_comments_dict.items():
@@ -174,9 +182,53 @@ def clustering(experts_comments_dict: dict[str, any]) -> pd.DataFrame:
                 keys.append(cell_key)
                 students.append(student)
                 reviewers.append(reviewer)
-    
-    # Кластеризация
-    labels = clusterer.cluster(comments, eps=15, min_samples=2)
+
+    return {'comments': comments, 'keys': keys, 'students': students, 'reviewers': reviewers}
+
+def prepare_clustering(experts_comments_dict: dict[str, any], clusterer: "Clusterer" = None, max_eps: float = 15,
+                       collected: dict = None, e5_embeddings: np.ndarray = None) -> dict:
+    '''Собирает комментарии задачи и один раз считает эмбеддинги и граф соседей для кластеризации'''
+    if clusterer is None:
+        from utils.clustering import Clusterer  # Кластеризация данных
+        clusterer = Clusterer()  # Эмбеддер берется из общего реестра
+    if collected is None:
+        collected = collect_comments(experts_comments_dict)
+
+    return {
+        **collected,
+        'sweep': clusterer.prepare(collected['comments'], max_eps=max_eps, e5_embeddings=e5_embeddings),
+    }
+
+def label_clustering(prepared: dict, ranker: "Ranker" = None, eps: float = 15, min_samples: int = 2,
+                     use_rake: bool = False) -> pd.DataFrame:
+    '''Извлекает кластеры для заданных eps и min_samples из подготовленной задачи и ранжирует комментарии'''
+    # Кластеризация по готовому графу соседей
+    sweep = prepared['sweep']
+    # Подписи кластеров строятся по уже обученному векторизатору задачи
+    vectorizer = sweep.feature_model.vectorizer if sweep.feature_model is not None else None
+    return build_clusters(prepared, sweep.labels(eps, min_samples), sweep.embeddings, ranker,
+                          vectorizer=vectorizer, use_rake=use_rake)
+
+def build_clusters(collected: dict, labels: np.ndarray, embeddings: np.ndarray, ranker: "Ranker" = None,
+                   renumber: bool = True, vectorizer=None, use_rake: bool = False) -> pd.DataFrame:
+    '''
+    Отбирает крупные кластеры задачи и ранжирует комментарии внутри них.
+
+    :param collected: Комментарии задачи (результат collect_comments).
+    :param labels: Метки DBSCAN для каждого комментария (-1 — шум).
+    :param embeddings: Эмбеддинги E5 комментариев для ранжирования.
+    :param ranker: Ранжировщик; по умолчанию создается новый.
+    :param renumber: Перенумеровать кластеры подряд с 1; иначе номер кластера — метка + 1,
+        чтобы номера не менялись между запусками инкрементальной кластеризации.
+    :param vectorizer: Обученный TF-IDF векторизатор для подписей кластеров (см. label_clusters).
+    :param use_rake: Уточнять подписи кластеров ключевыми фразами RAKE.
+    :return: Таблица комментариев с номерами и подписями кластеров.
+    '''
+    comments, keys = collected['comments'], collected['keys']
+    students, reviewers = collected['students'], collected['reviewers']
+
+    if len(np.unique(labels)) == 1 and -1 in labels:
+        labels = np.array([])
 
     if len(labels) == 0:
         print("Кластеризация не выявила никаких кластеров.")
@@ -197,7 +249,7 @@ def clustering(experts_comments_dict: dict[str, any]) -> pd.DataFrame:
     
     min_len = min(len(comments), len(labels), len(keys), len(students), len(reviewers))
     filtered_comments_labels_keys = [
-        (comments[i], labels[i], keys[i], students[i], reviewers[i])
+        (i, comments[i], labels[i], keys[i], students[i], reviewers[i])
         for i in range(min_len) if labels[i] != -1
     ]
 
@@ -207,19 +259,28 @@ def clustering(experts_comments_dict: dict[str, any]) -> pd.DataFrame:
         })
 
     # Разворачиваем фильтрованные данные
-    filtered_comments, filtered_labels, filtered_keys, filtered_students, filtered_reviewers = zip(*filtered_comments_labels_keys)
+    filtered_indices, filtered_comments, filtered_labels, filtered_keys, filtered_students, filtered_reviewers = zip(*filtered_comments_labels_keys)
 
+    # Индекс датафрейма совпадает с номером строки в матрице эмбеддингов
     comments_df = pd.DataFrame({
         'Ячейка': filtered_keys,
         'Студент': filtered_students,
         'Проверяющий': filtered_reviewers,
         'Комментарии': filtered_comments,
         'Кластер': filtered_labels
-    })
+    }, index=list(filtered_indices))
+
+    # Подписи всех кластеров задачи одним проходом class-based TF-IDF
+    from utils.clustering import label_clusters
+    cluster_names = label_clusters(list(filtered_comments), np.array(filtered_labels), vectorizer, refine=use_rake)
+    comments_df['Подпись'] = comments_df['Кластер'].map(cluster_names)
 
     # Присваиваем уникальные номера кластерам
-    unique_labels = {label: i + 1 for i, label in enumerate(sorted(set(filtered_labels))) if label != -1}
-    comments_df['Кластер'] = comments_df['Кластер'].map(unique_labels)
+    if renumber:
+        unique_labels = {label: i + 1 for i, label in enumerate(sorted(set(filtered_labels))) if label != -1}
+        comments_df['Кластер'] = comments_df['Кластер'].map(unique_labels)
+    else:
+        comments_df['Кластер'] = comments_df['Кластер'] + 1
 
     if comments_df.empty:
         print("Кластеров не было получено - не были найдены схожие комментарии.")
@@ -228,18 +289,55 @@ def clustering(experts_comments_dict: dict[str, any]) -> pd.DataFrame:
         })
     
     # Ранжирование
-    ranker = Ranker()
+    if ranker is None:
+        from utils.ranking import Ranker  # Ранжирование данных
+        ranker = Ranker()
 
     try:
-        # Сортируем комментарии внутри каждого кластера
-        clustered_df = comments_df.groupby('Кластер', group_keys=False).apply(
-            lambda group: group.iloc[ranker.rank(group['Комментарии'].tolist())]
-        ).reset_index(drop=True)
+        # Сортируем комментарии внутри всех кластеров задачи одним вызовом
+        orders = ranker.rank_all(
+            comments_df['Комментарии'].tolist(), comments_df['Кластер'].to_numpy(),
+            embeddings=embeddings[comments_df.index.to_numpy()],
+        )
+        positions = np.concatenate([orders[label] for label in sorted(orders)])
+        clustered_df = comments_df.iloc[positions]
     except TypeError as e:
         print("Ошибка при ранжировании: возможно, проблема с кластеризацией.", e)
-        return comments_df  
+        return comments_df.reset_index(drop=True)
 
-    return clustered_df.sort_values(by='Кластер').reset_index(drop=True)
+    return clustered_df.reset_index(drop=True)
+
+
+def clustering(experts_comments_dict: dict[str, any], clusterer: "Clusterer" = None, ranker: "Ranker" = None,
+               eps: float = 15, min_samples: int = 2) -> pd.DataFrame:
+    '''Кластеризует комментарии экспертов и возвращает информацию о кластерах'''
+    prepared = prepare_clustering(experts_comments_dict, clusterer, max_eps=eps)
+    return label_clustering(prepared, ranker, eps=eps, min_samples=min_samples)
+
+
+def incremental_clustering(collected: dict, model_path: str, clusterer: "Clusterer" = None, ranker: "Ranker" = None,
+                           eps: float = 15, min_samples: int = 2) -> pd.DataFrame:
+    '''
+    Кластеризует комментарии задачи, дополняя сохраненную модель кластеров (см. Clusterer.cluster_incremental).
+    Уже встречавшиеся комментарии сохраняют номера кластеров между запусками.
+
+    :param collected: Комментарии задачи (результат collect_comments).
+    :param model_path: Путь к файлу модели кластеров задачи.
+    :return: Таблица комментариев с номерами кластеров.
+    '''
+    if clusterer is None:
+        from utils.clustering import Clusterer  # Кластеризация данных
+        clusterer = Clusterer()
+    labels, embeddings, vectorizer = clusterer.cluster_incremental(
+        collected['comments'], model_path, eps=eps, min_samples=min_samples
+    )
+    return build_clusters(collected, labels, embeddings, ranker, renumber=False, vectorizer=vectorizer)
+
+def cluster_model_path(model_dir, file_path, task):
+    '''Путь к модели кластеров задачи: model_dir/<имя книги>/<задача>.joblib'''
+    # Streamlit передает загруженный файл, у которого есть только имя
+    workbook = os.path.splitext(os.path.basename(getattr(file_path, "name", str(file_path))))[0]
+    return os.path.join(model_dir, workbook, f"{task}.joblib")
 
 
 def create_formatted_dataframe(dataframes):
@@ -277,8 +375,10 @@ def create_formatted_dataframe(dataframes):
         
         # Обработка заголовков кластеров
         for cluster_num, cluster_df in df.groupby("Кластер"):
+            # Заголовок для каждого кластера с его автоматической подписью
+            name = cluster_df["Подпись"].iloc[0] if "Подпись" in cluster_df.columns else ""
             cluster_header = pd.DataFrame({
-                "Номер": [f"Кластер {cluster_num}:"],  # Заголовок для каждого кластера
+                "Номер": [f"Кластер {cluster_num}: {name}" if name else f"Кластер {cluster_num}:"],
                 "Студент": [""],
                 "Проверяющий": [""],
                 "Комментарии": [""]
@@ -291,7 +391,7 @@ def create_formatted_dataframe(dataframes):
         return pd.DataFrame(columns=["Номер", "Студент", "Проверяющий", "Комментарии"])
 
     final_df = pd.concat(formatted_dfs, ignore_index=True)
-    final_df = final_df.drop(columns=["Кластер","Задача"])
+    final_df = final_df.drop(columns=["Кластер","Задача","Подпись"], errors="ignore")
     final_df.fillna("", inplace=True)
     if "Студент" in final_df.columns:
         final_df["Студент"] = final_df["Студент"].apply(lambda x: x.split("+")[0] if isinstance(x, str) else x)
@@ -331,37 +431,209 @@ def save_results_to_excel(df, base_file_name):
     buffer.seek(0)
     return buffer
 
-def main(file_path, student_column, reviewer_column, comment_column_i, comment_column_o):
-    
+def _init_worker(num_threads):
+    '''Ограничивает число потоков BLAS/OpenMP/numba/torch в процессе-работнике, чтобы работники не конкурировали за ядра'''
+    # Переменные окружения действуют только на библиотеки, которые еще не импортированы
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMBA_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+    # При spawn работник заново импортирует главный модуль, и numpy с его BLAS уже загружены:
+    # их пулы потоков ограничиваются напрямую
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=num_threads)
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(num_threads)
+
+_worker_state = {}
+
+def _worker_clusterer(vocabulary_path=None):
+    '''Кластеризатор процесса-работника; модель в нем загружается только если эмбеддинги не переданы'''
+    if _worker_state.get('vocabulary_path', 'unset') != vocabulary_path:
+        from utils.clustering import Clusterer
+        # Словарь курса к этому моменту уже обучен и сохранен основным процессом
+        _worker_state['clusterer'] = Clusterer(vocabulary_path=vocabulary_path)
+        _worker_state['vocabulary_path'] = vocabulary_path
+    return _worker_state['clusterer']
+
+def _prepare_task(collected, e5_embeddings, max_eps, vocabulary_path=None):
+    return prepare_clustering(
+        None, _worker_clusterer(vocabulary_path), max_eps=max_eps, collected=collected, e5_embeddings=e5_embeddings
+    )
+
+def map_tasks(func, args_list, n_jobs=1):
+    """
+    Выполняет func для каждого набора аргументов, при n_jobs > 1 — в пуле процессов.
+    Результаты возвращаются в исходном порядке задач.
+
+    :param func: Функция уровня модуля (должна сериализоваться pickle).
+    :param args_list: Список кортежей аргументов.
+    :param n_jobs: Число процессов; 1 — последовательное выполнение в текущем процессе.
+    :return: Список результатов.
+    """
+    if n_jobs <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    n_jobs = min(n_jobs, len(args_list))
+    # Ядра делятся между работниками поровну
+    num_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    # spawn вместо fork: torch и OpenMP небезопасно копировать в дочерний процесс после инициализации
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(n_jobs, mp_context=context, initializer=_init_worker, initargs=(num_threads,)) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+def collect_workbook(file_path, student_column, reviewer_column, comment_column_i, comment_column_o):
+    """
+    Разбирает книгу и собирает комментарии каждой задачи.
+
+    :return: Список пар (задача, результат collect_comments).
+    """
     target_columns = [student_column, reviewer_column, comment_column_i, comment_column_o]
     all_task_data, cell_coordinates = find_columns_in_sheets(file_path, target_columns)
     task_names = all_task_data['Задача'].unique()
 
-    list_clustered_info = []
+    collected_tasks = []
     for task in task_names:
         task_data = all_task_data[all_task_data['Задача'] == task]
         if not task_data.empty:
-            print(f"Кластеризация для задачи {task}")
             experts_comments_dict = creating_dictionary(task_data, comment_column_i, comment_column_o, cell_coordinates)
            
             if not experts_comments_dict:  
-                print("Внимание: experts_comments_dict пустой. Пропускаем кластеризацию.")
+                print(f"Внимание: experts_comments_dict пустой для задачи {task}. Пропускаем кластеризацию.")
                 continue
-            clustered_info = clustering(experts_comments_dict)
-           
-            if not clustered_info.empty:
-                clustered_info['Задача'] = task
-                list_clustered_info.append(clustered_info)
-            else:
-                print("Данные не были найдены.")
-    final_df = create_formatted_dataframe(list_clustered_info)
+            collected_tasks.append((task, collect_comments(experts_comments_dict)))
+    return collected_tasks
 
-    
-    return final_df
+def prepare_workbook(file_path, student_column, reviewer_column, comment_column_i, comment_column_o, embedder=None,
+                     max_eps=MAX_EPS, shared_embeddings=True, n_jobs=1, vocabulary_path=None):
+    """
+    Разбирает книгу и для каждой задачи один раз считает эмбеддинги и граф соседей.
+
+    :param embedder: Эмбеддер; по умолчанию общий для процесса.
+    :param max_eps: Наибольший eps, который понадобится при перекластеризации.
+    :param shared_embeddings: Считать эмбеддинги комментариев всех задач одним проходом модели.
+    :param n_jobs: Число процессов для подготовки задач (TF-IDF, признаки, граф соседей).
+    :param vocabulary_path: Путь к словарю TF-IDF курса; словарь обучается на комментариях всех задач книги
+        при первом запуске и переобучается, только если дрейф словаря превышает порог.
+    :return: Список пар (задача, подготовленные данные).
+    """
+    from utils.clustering import Clusterer  # Кластеризация данных
+    from utils.embedder import get_embedder  # Общий для процесса эмбеддер
 
+    # Один эмбеддер и кластеризатор на всю книгу
+    embedder = embedder if embedder is not None else get_embedder()
+    clusterer = Clusterer(embedder, vocabulary_path=vocabulary_path)
 
+    collected_tasks = collect_workbook(file_path, student_column, reviewer_column, comment_column_i, comment_column_o)
+    if vocabulary_path is not None:
+        clusterer.update_vocabulary([c for _, collected in collected_tasks for c in collected['comments']])
 
+    # Эмбеддинги всех задач одним батчем; затем каждая задача получает свой срез
+    if shared_embeddings:
+        task_embeddings = clusterer.embed_many([collected['comments'] for _, collected in collected_tasks])
+    else:
+        task_embeddings = [None] * len(collected_tasks)
+
+    if n_jobs > 1:
+        print(f"Кластеризация {len(collected_tasks)} задач в {n_jobs} процессах")
+        prepared_list = map_tasks(
+            _prepare_task,
+            [
+                (collected, e5_embeddings, max_eps, vocabulary_path)
+                for (_, collected), e5_embeddings in zip(collected_tasks, task_embeddings)
+            ],
+            n_jobs=n_jobs,
+        )
+        return [(task, prepared) for (task, _), prepared in zip(collected_tasks, prepared_list)]
+
+    prepared_tasks = []
+    for (task, collected), e5_embeddings in zip(collected_tasks, task_embeddings):
+        print(f"Кластеризация для задачи {task}")
+        prepared = prepare_clustering(None, clusterer, max_eps=max_eps, collected=collected, e5_embeddings=e5_embeddings)
+        prepared_tasks.append((task, prepared))
+    return prepared_tasks
+
+def cluster_workbook(prepared_tasks, eps=15, min_samples=2, embedder=None, use_rake=False,
+                     ranking_engine="pca", ranking_jobs=1):
+    """
+    Извлекает кластеры из подготовленных задач и формирует итоговую таблицу.
+    Модель и признаки не пересчитываются, поэтому вызов с другими eps/min_samples быстрый;
+    он выполняется в текущем процессе, так как пересылка графов соседей в пул процессов дороже самого DBSCAN.
+
+    :param prepared_tasks: Результат prepare_workbook.
+    :param eps: Порог расстояния DBSCAN (не больше max_eps из prepare_workbook).
+    :param min_samples: Минимальное количество точек для образования кластера.
+    :param embedder: Эмбеддер для ранжировщика; по умолчанию общий для процесса.
+    :param use_rake: Уточнять подписи кластеров ключевыми фразами RAKE.
+    :param ranking_engine: Способ упорядочивания комментариев в кластере: "pca", "spectral", "chain" или "umap".
+    :param ranking_jobs: Число потоков для ранжирования кластеров задачи.
+    :return: Итоговая таблица.
+    """
+    from utils.ranking import Ranker  # Ранжирование данных
 
+    ranker = Ranker(embedder, engine=ranking_engine, n_jobs=ranking_jobs)
+    clustered_list = [
+        label_clustering(prepared, ranker, eps=eps, min_samples=min_samples, use_rake=use_rake)
+        for _, prepared in prepared_tasks
+    ]
+    for engine, stats in ranker.timing_summary().items():
+        print(f"Ранжирование ({engine}): {stats['calls']} кластеров, {stats['mean_ms']:.1f} мс на кластер")
 
+    # Порядок задач сохраняется, как того ожидает create_formatted_dataframe
+    list_clustered_info = []
+    for (task, _), clustered_info in zip(prepared_tasks, clustered_list):
+       
+        if not clustered_info.empty:
+            clustered_info['Задача'] = task
+            list_clustered_info.append(clustered_info)
+        else:
+            print("Данные не были найдены.")
+    return create_formatted_dataframe(list_clustered_info)
 
+def main(file_path, student_column, reviewer_column, comment_column_i, comment_column_o, embedder=None,
+         eps=15, min_samples=2, n_jobs=1, model_dir=None, vocabulary_path=None, ranking_engine="pca", ranking_jobs=1):
+    """
+    Кластеризует комментарии всех задач книги.
+
+    :param model_dir: Папка для моделей кластеров задач; если задана, каждая задача кластеризуется
+        инкрементально: новые комментарии присоединяются к сохраненным кластерам, а номера кластеров
+        уже встречавшихся комментариев не меняются между запусками.
+    :param vocabulary_path: Путь к словарю TF-IDF курса (см. prepare_workbook).
+    :param ranking_engine: Способ упорядочивания комментариев в кластере (см. cluster_workbook).
+    :param ranking_jobs: Число потоков для ранжирования кластеров задачи (см. cluster_workbook).
+    :return: Итоговая таблица.
+    """
+    if model_dir is not None:
+        from utils.clustering import Clusterer  # Кластеризация данных
+        from utils.embedder import get_embedder  # Общий для процесса эмбеддер
+        from utils.ranking import Ranker  # Ранжирование данных
+
+        embedder = embedder if embedder is not None else get_embedder()
+        clusterer = Clusterer(embedder, vocabulary_path=vocabulary_path)
+        ranker = Ranker(embedder, engine=ranking_engine, n_jobs=ranking_jobs)
+        list_clustered_info = []
+        collected_tasks = collect_workbook(file_path, student_column, reviewer_column, comment_column_i, comment_column_o)
+        if vocabulary_path is not None:
+            clusterer.update_vocabulary([c for _, collected in collected_tasks for c in collected['comments']])
+        for task, collected in collected_tasks:
+            print(f"Кластеризация для задачи {task}")
+            clustered_info = incremental_clustering(
+                collected, cluster_model_path(model_dir, file_path, task), clusterer, ranker,
+                eps=eps, min_samples=min_samples,
+            )
+            if not clustered_info.empty:
+                clustered_info['Задача'] = task
+                list_clustered_info.append(clustered_info)
+            else:
+                print("Данные не были найдены.")
+        return create_formatted_dataframe(list_clustered_info)
+
+    prepared_tasks = prepare_workbook(
+        file_path, student_column, reviewer_column, comment_column_i, comment_column_o, embedder=embedder, max_eps=eps,
+        n_jobs=n_jobs, vocabulary_path=vocabulary_path,
+    )
+    final_df = cluster_workbook(
+        prepared_tasks, eps=eps, min_samples=min_samples, embedder=embedder, ranking_engine=ranking_engine,
+        ranking_jobs=ranking_jobs,
+    )
 
+    
+    return final_df
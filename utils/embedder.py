@@ -1,22 +1,140 @@
+import logging
+import os
+import threading
+import typing as tp
+
 import numpy as np
 import torch
 from torch import Tensor
 from transformers import AutoModel, AutoTokenizer
 
+from utils.embedding_cache import EmbeddingCache
+from utils.resources import resolve_model_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = "intfloat/multilingual-e5-small"
+BACKENDS = ("torch", "torch-int8", "onnx")
+ONNX_DIR = os.path.join(".cache", "onnx")
+
+# Реестр загруженных моделей: (model_name, device, dtype, backend) -> E5Embedder
+_EMBEDDERS: dict[tuple[str, str, str, str], "E5Embedder"] = {}
+_EMBEDDERS_LOCK = threading.Lock()
+
 
 class E5Embedder:
     """
     Класс для создания эмбеддингов с использованием модели E5.
     """
 
-    def __init__(self, model_name: str = "intfloat/multilingual-e5-small"):
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL_NAME,
+        device: str = "cpu",
+        dtype: str = "float32",
+        batch_size: int = 32,
+        cache: EmbeddingCache | None = None,
+        backend: str = "torch",
+        onnx_path: str | None = None,
+    ):
         """
         Инициализация эмбеддера.
         * model_name : str
             Название предобученной модели (по умолчанию "intfloat/multilingual-e5-small").
+        * device : str
+            Устройство для вычислений (по умолчанию "cpu").
+        * dtype : str
+            Тип весов модели, например "float32" или "float16" (по умолчанию "float32").
+        * batch_size : int
+            Размер мини-батча при инференсе (по умолчанию 32).
+        * cache : EmbeddingCache | None
+            Дисковый кэш эмбеддингов; модель запускается только для текстов, которых нет в кэше.
+        * backend : str
+            Движок инференса: "torch" (fp32/fp16 PyTorch), "torch-int8" (динамическая int8-квантизация
+            линейных слоев) или "onnx" (экспортированный граф в onnxruntime). По умолчанию "torch".
+        * onnx_path : str | None
+            Путь к ONNX-графу для backend="onnx"; если файла нет, граф экспортируется из модели.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Неизвестный backend {backend!r}, доступны: {', '.join(BACKENDS)}")
+        if backend != "torch" and (device != "cpu" or dtype != "float32"):
+            raise ValueError(f"backend {backend!r} поддерживает только device='cpu' и dtype='float32'")
+
+        self.model_name = model_name
+        self.backend = backend
+        self.prefix = "passage: "
+        self.batch_size = batch_size
+        self.cache = cache
+        # Квантизованные и fp16 эмбеддинги немного отличаются от fp32, поэтому хранятся в кэше отдельно
+        self.cache_model_name = model_name if backend == "torch" else f"{model_name}@{backend}"
+        if dtype != "float32":
+            self.cache_model_name = f"{self.cache_model_name}@{dtype}"
+        self.device = torch.device(device)
+        self.dtype = getattr(torch, dtype)
+        # Модель читается только из локальной папки, подготовленной командой `python -m utils.resources`
+        model_path = resolve_model_path(model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            model_path, use_fast=True, local_files_only=True, clean_up_tokenization_spaces=True
+        )
+        # Верхняя граница длины в токенах, которую поддерживает модель
+        self.model_max_length = min(self.tokenizer.model_max_length, 512)
+        # Число служебных токенов в конце последовательности: при обрезке они сохраняются
+        special_mask = self.tokenizer(self.prefix, return_special_tokens_mask=True)["special_tokens_mask"]
+        self._trailing_special = next(
+            (i for i, flag in enumerate(reversed(special_mask)) if not flag), len(special_mask)
+        )
+        # Статистика последнего планирования длин: max_length, число обрезанных текстов, длины батчей
+        # (каждый вызов заполняет свой словарь, поэтому одновременные вызовы не смешивают статистику)
+        self.last_length_plan: dict[str, tp.Any] = {}
+        # Быстрый токенизатор на Rust нельзя вызывать из нескольких потоков одновременно: смена параметров
+        # обрезки меняет его состояние ("Already borrowed"), а эмбеддер общий для всех сессий Streamlit
+        self._tokenizer_lock = threading.Lock()
+        self.model = AutoModel.from_pretrained(model_path, torch_dtype=self.dtype, local_files_only=True)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+        self.hidden_size = self.model.config.hidden_size
+        self.session = None
+
+        if backend == "torch-int8":
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == "onnx":
+            onnx_path = onnx_path or os.path.join(ONNX_DIR, model_name.replace("/", "__") + ".onnx")
+            self.session = self._load_onnx_session(onnx_path)
+            # Веса PyTorch больше не нужны
+            self.model = None
+
+    def _load_onnx_session(self, onnx_path: str):
         """
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, clean_up_tokenization_spaces=True)
-        self.model = AutoModel.from_pretrained(model_name)
+        Загружает ONNX-граф модели в onnxruntime, при необходимости предварительно экспортируя его.
+        * onnx_path : str
+            Путь к файлу .onnx.
+
+        Возвращает:
+        * onnxruntime.InferenceSession : Сессия для инференса на CPU.
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("Для backend='onnx' необходимо установить пакет onnxruntime") from e
+
+        if not os.path.exists(onnx_path):
+            os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+            dummy = dict(self.tokenizer([f"{self.prefix}пример текста"], return_tensors="pt"))
+            input_names = list(dummy)
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+            torch.onnx.export(
+                self.model,
+                (dummy,),
+                onnx_path,
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
 
     @staticmethod
     def average_pool(hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
@@ -35,35 +153,330 @@ class E5Embedder:
         # Вычисление среднего значения скрытых состояний с учетом маски
         return hidden_states.sum(dim=1) / attention_mask.sum(dim=1, keepdim=True)
 
-    def get_embeddings(self, texts: list[str]) -> np.ndarray:
+    def _embed_batch(self, features: list[dict[str, list[int]]]) -> np.ndarray:
         """
-        Генерация эмбеддингов для списка текстов.
+        Прогоняет через модель один мини-батч уже токенизированных текстов.
+        * features : list[dict[str, list[int]]]
+            Токенизированные тексты без паддинга.
+
+        Возвращает:
+        * np.ndarray : Эмбеддинги батча размерности (B, D).
+        """
+        # Паддинг только до длины самого длинного текста в батче
+        with self._tokenizer_lock:
+            batch = self.tokenizer.pad(features, padding=True, return_tensors="pt")
+        batch = batch.to(self.device)
+
+        if self.session is not None:
+            # Инференс экспортированного графа в onnxruntime
+            inputs = {node.name: batch[node.name].numpy() for node in self.session.get_inputs()}
+            (hidden_states,) = self.session.run(["last_hidden_state"], inputs)
+            hidden_states = torch.from_numpy(hidden_states)
+        else:
+            # Получение скрытых состояний модели без вычисления градиентов
+            with torch.no_grad():
+                hidden_states = self.model(**batch).last_hidden_state
+
+        # Вычисление эмбеддингов через среднее пуллинг
+        embeddings = self.average_pool(hidden_states, batch["attention_mask"])
+        return embeddings.float().cpu().numpy()
+
+    def _max_length_for(self, lengths: np.ndarray) -> int:
+        """
+        Выбирает ограничение длины: 97.5-й перцентиль длин в токенах, округленный вверх до степени двойки
+        (не меньше 128 и не больше предела модели).
+        * lengths : np.ndarray
+            Длины текстов в токенах.
+
+        Возвращает:
+        * int : Ограничение длины.
+        """
+        return min(max(int(2 ** np.ceil(np.log2(np.quantile(lengths, 0.975)))), 128), self.model_max_length)
+
+    def tokenize(self, texts: list[str]) -> list[dict[str, list[int]]]:
+        """
+        Токенизирует тексты (с префиксом) без обрезки и паддинга.
+        Результат можно передать в get_embeddings, чтобы тексты не токенизировались повторно.
+        * texts : list[str]
+            Список текстов (без префикса).
+
+        Возвращает:
+        * list[dict[str, list[int]]] : Токенизированные тексты.
+        """
+        with self._tokenizer_lock:
+            encoded = self.tokenizer([f"{self.prefix}{text}" for text in texts], truncation=False, verbose=False)
+        return [{key: encoded[key][i] for key in encoded.keys()} for i in range(len(texts))]
+
+    def plan_max_length(self, texts: list[str], features: list[dict[str, list[int]]] | None = None) -> int:
+        """
+        Возвращает max_length, который get_embeddings выберет для этого списка текстов.
+        Нужен, чтобы эмбеддинги нескольких списков, посчитанные одним вызовом, совпадали с посчитанными по отдельности.
+        * texts : list[str]
+            Список текстов (без префикса).
+        * features : list[dict[str, list[int]]] | None
+            Результат tokenize(texts); если не передан, тексты токенизируются.
+
+        Возвращает:
+        * int : Ограничение длины в токенах.
+        """
+        if not texts:
+            raise ValueError("Список текстов пуст")
+        features = self.tokenize(texts) if features is None else features
+        return self._max_length_for(np.array([len(feature["input_ids"]) for feature in features]))
+
+    @staticmethod
+    def _bucket_caps(lengths: np.ndarray, max_length: int) -> np.ndarray:
+        """
+        Раскладывает тексты по корзинам длины: у каждой корзины свое ограничение — степень двойки
+        от 128 до max_length, и текст попадает в наименьшую корзину, в которую помещается.
+        Тексты длиннее max_length попадают в последнюю корзину и обрезаются.
+        * lengths : np.ndarray
+            Длины текстов в токенах.
+        * max_length : int
+            Общее ограничение длины.
+
+        Возвращает:
+        * np.ndarray : Ограничение длины корзины каждого текста.
+        """
+        caps = np.maximum(2 ** np.ceil(np.log2(np.maximum(lengths, 1))), 128).astype(int)
+        return np.minimum(caps, max_length)
+
+    def _truncate(self, feature: dict[str, list[int]], max_length: int) -> dict[str, list[int]]:
+        """Обрезает токенизированный текст до max_length, как токенизатор: служебные токены в конце сохраняются."""
+        keep = max_length - self._trailing_special
+        return {key: values[:keep] + values[len(values) - self._trailing_special :] for key, values in feature.items()}
+
+    def _plan_lengths(
+        self, texts: list[str], max_length: int | None = None, features: list[dict[str, list[int]]] | None = None
+    ) -> tuple[list[dict[str, list[int]]], np.ndarray, dict[str, tp.Any]]:
+        """
+        Токенизирует тексты быстрым токенизатором и выбирает ограничение длины по реальному числу токенов.
+        * texts : list[str]
+            Тексты (без префикса).
+        * max_length : int | None
+            Явное ограничение длины; если не задано, берется 97.5-й перцентиль длин в токенах,
+            округленный вверх до степени двойки (не меньше 128 и не больше предела модели).
+        * features : list[dict[str, list[int]]] | None
+            Уже токенизированные тексты (результат tokenize); если не переданы, тексты токенизируются.
+
+        Возвращает:
+        * list[dict[str, list[int]]] : Токенизированные тексты без паддинга (длинные обрезаны до max_length).
+        * np.ndarray : Исходные длины текстов в токенах (до обрезки).
+        * dict[str, Any] : План: выбранное ограничение длины (max_length), число обрезанных текстов,
+          размеры корзин и пустой список длин батчей.
+        """
+        # Одна токенизация без обрезки дает точные длины
+        features = self.tokenize(texts) if features is None else list(features)
+        lengths = np.array([len(feature["input_ids"]) for feature in features])
+
+        max_length = self._max_length_for(lengths) if max_length is None else min(max_length, self.model_max_length)
+
+        # Тексты, которые не помещаются в max_length, обрезаются без повторной токенизации
+        truncated = np.flatnonzero(lengths > max_length)
+        if len(truncated):
+            for i in truncated:
+                features[i] = self._truncate(features[i], max_length)
+            logger.info("Обрезано текстов до %d токенов: %d из %d", max_length, len(truncated), len(texts))
+
+        caps, counts = np.unique(self._bucket_caps(lengths, max_length), return_counts=True)
+        plan = {
+            "max_length": max_length,
+            "truncated": len(truncated),
+            "buckets": {int(cap): int(count) for cap, count in zip(caps, counts)},
+            "batch_lengths": [],
+        }
+        return features, lengths, plan
+
+    def get_embeddings_iter(
+        self,
+        texts: list[str],
+        batch_size: int | None = None,
+        max_length: int | None = None,
+        dtype: tp.Any = np.float32,
+        out: np.ndarray | None = None,
+        features: list[dict[str, list[int]]] | None = None,
+    ) -> tp.Iterator[tuple[np.ndarray, np.ndarray]]:
+        """
+        Потоковая генерация эмбеддингов: отдает результаты частями по мере вычисления.
+        Сначала отдаются найденные в кэше эмбеддинги, затем — мини-батчи в порядке возрастания длины.
         * texts : list[str]
             Список входных текстов.
+        * batch_size : int | None
+            Размер мини-батча; если не задан, используется self.batch_size.
+        * max_length : int | None
+            Ограничение длины в токенах; если не задано, выбирается по распределению длин (см. _plan_lengths).
+        * dtype : np.dtype
+            Тип отдаваемых эмбеддингов, например np.float16 для экономии памяти (по умолчанию np.float32).
+        * out : np.ndarray | None
+            Массив размерности (N, D) (в том числе np.memmap), в который эмбеддинги записываются по мере вычисления.
+        * features : list[dict[str, list[int]]] | None
+            Уже токенизированные тексты (результат tokenize), чтобы не токенизировать их повторно.
 
         Возвращает:
-        * np.ndarray : Массив эмбеддингов размерности (N, D), где N — количество текстов, D — размер эмбеддинга.
+        * Iterator[tuple[np.ndarray, np.ndarray]] : Пары (индексы текстов, эмбеддинги размерности (len(индексы), D)).
         """
         # Предобработка текстов
         if not texts:
             raise ValueError("Список текстов пуст")
-        input_texts = [f"passage: {text}" for text in texts]
+        if out is not None and out.shape != (len(texts), self.hidden_size):
+            raise ValueError(f"Размер out {out.shape} не совпадает с ({len(texts)}, {self.hidden_size})")
+        if features is not None and len(features) != len(texts):
+            raise ValueError("Количество токенизированных текстов не совпадает с количеством текстов")
+        batch_size = batch_size or self.batch_size
 
-        # Определение максимальной длины на основе 97.5-го перцентиля
-        max_length = min(
-            max(int(2 ** np.ceil(np.log2(np.quantile([len(t.split()) for t in input_texts], 0.975)))), 128), 512
-        )
+        # Токенизация и выбор max_length по реальным длинам в токенах
+        features, lengths, plan = self._plan_lengths(texts, max_length, features)
+        max_length = plan["max_length"]
+        self.last_length_plan = plan
+
+        def emit(indices: np.ndarray, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            vectors = vectors.astype(dtype, copy=False)
+            if out is not None:
+                out[indices] = vectors
+            return indices, vectors
+
+        # Поиск в кэше; max_length входит в ключ только для обрезанных текстов,
+        # так как на необрезанные он не влияет
+        todo = np.arange(len(texts))
+        duplicates = {i: [i] for i in todo}
+        if self.cache is not None:
+            keys = [
+                self.cache.make_key(self.cache_model_name, self.prefix, max_length if length > max_length else 0, text)
+                for text, length in zip(texts, lengths)
+            ]
+            cached = self.cache.get_many(keys)
+            hits = [i for i, key in enumerate(keys) if key in cached]
+            if hits:
+                yield emit(np.array(hits), np.stack([cached[keys[i]] for i in hits]))
+
+            # Повторяющиеся промахи считаются один раз и затем копируются на все позиции
+            first_index = {}
+            for i, key in enumerate(keys):
+                if key not in cached:
+                    first_index.setdefault(key, i)
+            duplicates = {i: [] for i in first_index.values()}
+            for i, key in enumerate(keys):
+                if key not in cached:
+                    duplicates[first_index[key]].append(i)
+            todo = np.array(list(first_index.values()), dtype=int)
+
+        # Сортировка по длине, чтобы в батч попадали тексты близкой длины; батчи не пересекают границы корзин
+        order = todo[np.argsort(lengths[todo], kind="stable")]
+        caps = self._bucket_caps(lengths[order], max_length)
+        bounds = np.flatnonzero(np.diff(caps)) + 1
+        batches = [
+            bucket[start : start + batch_size]
+            for bucket in np.split(order, bounds)
+            for start in range(0, len(bucket), batch_size)
+        ]
 
-        # Токенизация текстов
-        tokenized_inputs = self.tokenizer(
-            input_texts, max_length=max_length, padding=True, truncation=True, return_tensors="pt"
+        for batch_idx in batches:
+            # Батч дополняется паддингом только до своего самого длинного текста (не дальше ограничения корзины)
+            plan["batch_lengths"].append(int(min(lengths[batch_idx[-1]], max_length)))
+            vectors = self._embed_batch([features[i] for i in batch_idx])
+
+            if self.cache is not None:
+                self.cache.put_many({keys[i]: vector for i, vector in zip(batch_idx, vectors)})
+
+            # Исходные позиции всех текстов батча (включая дубликаты)
+            repeats = [len(duplicates[i]) for i in batch_idx]
+            indices = np.array([j for i in batch_idx for j in duplicates[i]], dtype=int)
+            yield emit(indices, np.repeat(vectors, repeats, axis=0))
+
+    def get_embeddings(
+        self,
+        texts: list[str],
+        batch_size: int | None = None,
+        max_length: int | None = None,
+        dtype: tp.Any = np.float32,
+        features: list[dict[str, list[int]]] | None = None,
+    ) -> np.ndarray:
+        """
+        Генерация эмбеддингов для списка текстов.
+        Тексты сортируются по длине в токенах и обрабатываются мини-батчами,
+        поэтому пиковая память не зависит от количества текстов.
+        * texts : list[str]
+            Список входных текстов.
+        * batch_size : int | None
+            Размер мини-батча; если не задан, используется self.batch_size.
+        * max_length : int | None
+            Ограничение длины в токенах; если не задано, выбирается по распределению длин (см. _plan_lengths).
+        * dtype : np.dtype
+            Тип результата, например np.float16 (по умолчанию np.float32).
+        * features : list[dict[str, list[int]]] | None
+            Уже токенизированные тексты (результат tokenize), чтобы не токенизировать их повторно.
+
+        Возвращает:
+        * np.ndarray : Массив эмбеддингов размерности (N, D), где N — количество текстов, D — размер эмбеддинга.
+        """
+        if not texts:
+            raise ValueError("Список текстов пуст")
+        # Результаты батчей записываются на исходные позиции
+        embeddings = np.empty((len(texts), self.hidden_size), dtype=dtype)
+        chunks = self.get_embeddings_iter(
+            texts, batch_size=batch_size, max_length=max_length, dtype=dtype, out=embeddings, features=features
         )
+        for _ in chunks:
+            pass
+        return embeddings
+
+def get_embedder(
+    model_name: str = DEFAULT_MODEL_NAME, device: str = "cpu", dtype: str = "float32", backend: str = "torch"
+) -> E5Embedder:
+    """
+    Возвращает общий для процесса экземпляр эмбеддера, загружая модель только при первом обращении.
+    * model_name : str
+        Название предобученной модели.
+    * device : str
+        Устройство для вычислений.
+    * dtype : str
+        Тип весов модели.
+    * backend : str
+        Движок инференса ("torch", "torch-int8" или "onnx").
 
-        # Получение скрытых состояний модели без вычисления градиентов
-        with torch.no_grad():
-            outputs = self.model(**tokenized_inputs)
+    Возвращает:
+    * E5Embedder : Загруженный эмбеддер для заданной комбинации параметров.
+    """
+    key = (model_name, str(device), str(dtype), backend)
+    with _EMBEDDERS_LOCK:
+        if key not in _EMBEDDERS:
+            _EMBEDDERS[key] = E5Embedder(model_name, device=device, dtype=dtype, backend=backend)
+        return _EMBEDDERS[key]
 
-        # Вычисление эмбеддингов через среднее пуллинг
-        embeddings = self.average_pool(outputs.last_hidden_state, tokenized_inputs["attention_mask"])
 
-        return embeddings.detach().cpu().numpy()
+def check_backend_parity(
+    embedder: E5Embedder, texts: list[str], reference: E5Embedder | None = None, threshold: float = 0.99
+) -> float:
+    """
+    Сравнивает эмбеддинги выбранного движка с эталонной fp32-моделью PyTorch.
+    * embedder : E5Embedder
+        Проверяемый эмбеддер.
+    * texts : list[str]
+        Контрольные тексты.
+    * reference : E5Embedder | None
+        Эталонный эмбеддер; по умолчанию общий fp32-эмбеддер той же модели.
+    * threshold : float
+        Минимально допустимое косинусное сходство (по умолчанию 0.99).
+
+    Возвращает:
+    * float : Минимальное по текстам косинусное сходство с эталоном.
+    """
+    if reference is None:
+        reference = get_embedder(embedder.model_name)
+    # Кэш отключается, чтобы сравнивались именно выходы моделей
+    cache, reference_cache = embedder.cache, reference.cache
+    embedder.cache = reference.cache = None
+    try:
+        candidate, expected = embedder.get_embeddings(texts), reference.get_embeddings(texts)
+    finally:
+        embedder.cache, reference.cache = cache, reference_cache
+
+    similarity = np.sum(candidate * expected, axis=1) / (
+        np.linalg.norm(candidate, axis=1) * np.linalg.norm(expected, axis=1)
+    )
+    min_similarity = float(similarity.min())
+    if min_similarity < threshold:
+        raise ValueError(
+            f"Backend {embedder.backend!r}: косинусное сходство с fp32 {min_similarity:.4f} ниже порога {threshold}"
+        )
+    return min_similarity
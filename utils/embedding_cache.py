@@ -0,0 +1,143 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Постоянный кэш эмбеддингов на диске (SQLite), адресуемый по содержимому текста.
+    Ключ строится из названия модели, префикса, max_length и хэша нормализованного текста.
+    Кэш можно использовать одновременно из нескольких процессов приложения.
+    """
+
+    def __init__(self, path: str, max_entries: int = 200_000, timeout: float = 30.0):
+        """
+        Открывает (или создает) кэш.
+        * path : str
+            Путь к файлу базы SQLite.
+        * max_entries : int
+            Максимальное число векторов в кэше; при превышении удаляются давно не использованные (по умолчанию 200000).
+        * timeout : float
+            Время ожидания блокировки базы другим процессом в секундах (по умолчанию 30).
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего процесса, открывая его при первом обращении (в том числе после fork)."""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            # WAL позволяет читать параллельно с записью из других процессов
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Нормализует текст для построения ключа: Unicode NFC и схлопывание пробелов.
+        * text : str
+            Исходный текст.
+
+        Возвращает:
+        * str : Нормализованный текст.
+        """
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    @classmethod
+    def make_key(cls, model_name: str, prefix: str, max_length: int, text: str) -> str:
+        """
+        Строит ключ кэша.
+        * model_name : str
+            Название модели.
+        * prefix : str
+            Префикс, добавляемый к тексту перед токенизацией.
+        * max_length : int
+            Ограничение длины в токенах, с которым текст подается в модель.
+        * text : str
+            Текст.
+
+        Возвращает:
+        * str : Хэш SHA-1 в шестнадцатеричном виде.
+        """
+        payload = "\x1f".join([model_name, prefix, str(max_length), cls.normalize(text)])
+        return hashlib.sha1(payload.encode("utf8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """
+        Достает из кэша векторы для переданных ключей и отмечает их как использованные.
+        * keys : list[str]
+            Ключи.
+
+        Возвращает:
+        * dict[str, np.ndarray] : Найденные векторы (отсутствующие ключи пропускаются).
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # SQLite ограничивает число параметров в запросе
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+                conn.commit()
+        return found
+
+    def put_many(self, items: dict[str, np.ndarray]) -> None:
+        """
+        Сохраняет векторы в кэш и при необходимости вытесняет давно не использованные записи.
+        * items : dict[str, np.ndarray]
+            Ключи и соответствующие им векторы.
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def close(self) -> None:
+        """Закрывает соединение с базой."""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn, self._pid = None, None
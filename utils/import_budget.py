@@ -0,0 +1,78 @@
+"""
+Проверка бюджета времени импорта модулей, которые загружает app.py при старте.
+
+Запуск из корня проекта:
+    python -m utils.import_budget
+
+Каждый модуль импортируется в отдельном процессе с `python -X importtime`.
+Скрипт завершается с ненулевым кодом, если модуль не импортируется, импортируется дольше бюджета
+или тянет за собой тяжелые зависимости (torch, transformers, umap и т.д.).
+Проверка запускается в CI (.github/workflows/import-budget.yml).
+"""
+
+import subprocess
+import sys
+
+# Бюджет на импорт модуля в секундах (накопленное время по данным -X importtime)
+IMPORT_BUDGETS = {
+    "utils.clustering_comments_dbscan": 1.0,
+    "utils.embedding_cache": 0.5,
+    "utils.search_notebooks": 0.5,
+    "utils.results_students": 1.0,
+}
+
+# Модули, которые не должны загружаться при старте приложения
+HEAVY_MODULES = ("torch", "transformers", "umap", "datasketch", "networkx", "nltk", "sklearn", "rake_nltk")
+
+
+def measure_import(module: str) -> tuple[float, list[str]]:
+    """
+    Импортирует модуль в чистом процессе и измеряет время импорта.
+    * module : str
+        Имя модуля.
+
+    Возвращает:
+    * float : Накопленное время импорта модуля в секундах.
+    * list[str] : Тяжелые модули, загруженные вместе с ним.
+
+    Исключения:
+    * ImportError : Модуль не импортируется (текст ошибки — последняя строка stderr дочернего процесса).
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        raise ImportError(errors[-1] if errors else f"код завершения {result.returncode}")
+
+    # Формат строк: "import time: self [us] | cumulative | imported package"
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            cumulative_us = int(cumulative)
+
+    heavy = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative_us / 1e6, heavy
+
+
+def main() -> int:
+    failed = False
+    for module, budget in IMPORT_BUDGETS.items():
+        try:
+            seconds, heavy = measure_import(module)
+        except ImportError as error:
+            print(f"FAIL {module}: не импортируется ({error})")
+            failed = True
+            continue
+        status = "OK"
+        if seconds > budget or heavy:
+            status, failed = "FAIL", True
+        extra = f", тяжелые зависимости: {', '.join(heavy)}" if heavy else ""
+        print(f"{status:4} {module}: {seconds:.3f} с (бюджет {budget:.1f} с){extra}")
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
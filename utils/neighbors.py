@@ -0,0 +1,472 @@
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import sort_graph_by_row_values
+from sklearn.preprocessing import normalize
+
+
+def cosine_radius_graph(vectors: np.ndarray, radius: float, max_block_mb: float = 64.0) -> sp.csr_matrix:
+    """
+    Строит разреженный граф соседей в радиусе по косинусному расстоянию.
+    Расстояния считаются блоками строк, поэтому память ограничена max_block_mb, а не O(N²).
+    * vectors : np.ndarray
+        Матрица векторов размерности (N, D); внутри нормализуется по L2.
+    * radius : float
+        Максимальное косинусное расстояние (1 - косинусное сходство) между соседями.
+    * max_block_mb : float
+        Ограничение памяти на один блок матрицы расстояний в мегабайтах (по умолчанию 64).
+
+    Возвращает:
+    * sp.csr_matrix : Матрица (N, N) с расстояниями до соседей; совпадающие точки хранятся как явные нули,
+      поэтому граф можно подавать в DBSCAN(metric="precomputed").
+    """
+    X = normalize(np.asarray(vectors, dtype=np.float32))
+    n = X.shape[0]
+    block_size = max(1, int(max_block_mb * 2**20 / (4 * max(n, 1))))
+
+    rows, cols, data = [], [], []
+    for start in range(0, n, block_size):
+        distances = 1.0 - X[start : start + block_size] @ X.T
+        # Погрешности округления могут дать отрицательные расстояния для совпадающих векторов
+        np.maximum(distances, 0.0, out=distances)
+        r, c = np.nonzero(distances <= radius)
+        rows.append(r + start)
+        cols.append(c)
+        data.append(distances[r, c])
+
+    if not rows:
+        return sp.csr_matrix((n, n), dtype=np.float32)
+    # Явные нули сохраняются при переводе из COO в CSR
+    graph = sp.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n)).tocsr()
+    # DBSCAN ожидает соседей, отсортированных по расстоянию, иначе сортирует сам и предупреждает при каждом вызове
+    return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+
+def nearest_neighbor(
+    queries: np.ndarray, points: np.ndarray, metric: str = "cosine", max_block_mb: float = 64.0
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Находит для каждого запроса ближайшую точку перебором по блокам.
+    * queries : np.ndarray
+        Запросы размерности (M, D).
+    * points : np.ndarray
+        Точки размерности (N, D), N >= 1.
+    * metric : str
+        "cosine" (1 - косинусное сходство) или "euclidean".
+    * max_block_mb : float
+        Ограничение памяти на один блок матрицы расстояний в мегабайтах (по умолчанию 64).
+
+    Возвращает:
+    * np.ndarray : Индексы ближайших точек размерности (M,).
+    * np.ndarray : Расстояния до них размерности (M,).
+    """
+    Q = np.asarray(queries, dtype=np.float32)
+    P = np.asarray(points, dtype=np.float32)
+    if metric == "cosine":
+        Q, P = normalize(Q), normalize(P)
+    else:
+        P_sq = np.einsum("ij,ij->i", P, P)
+    block_size = max(1, int(max_block_mb * 2**20 / (4 * max(P.shape[0], 1))))
+
+    indices = np.empty(Q.shape[0], dtype=int)
+    distances = np.empty(Q.shape[0], dtype=np.float32)
+    for start in range(0, Q.shape[0], block_size):
+        block = Q[start : start + block_size]
+        if metric == "cosine":
+            block_distances = 1.0 - block @ P.T
+        else:
+            # |q - p|² = |q|² - 2 q·p + |p|²
+            block_distances = np.einsum("ij,ij->i", block, block)[:, None] - 2 * block @ P.T + P_sq[None, :]
+        nearest = np.argmin(block_distances, axis=1)
+        indices[start : start + len(block)] = nearest
+        distances[start : start + len(block)] = block_distances[np.arange(len(block)), nearest]
+
+    np.maximum(distances, 0.0, out=distances)
+    if metric != "cosine":
+        distances = np.sqrt(distances)
+    return indices, distances
+
+
+def _symmetric_csr(rows: np.ndarray, cols: np.ndarray, data: np.ndarray, n: int) -> sp.csr_matrix:
+    """Собирает симметричный граф из списка ребер, сохраняя явные нули и не складывая повторы."""
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    data = np.concatenate([data, data])
+    _, unique = np.unique(rows.astype(np.int64) * n + cols, return_index=True)
+    graph = sp.coo_matrix((data[unique], (rows[unique], cols[unique])), shape=(n, n)).tocsr()
+    return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+
+class ExactNeighbors:
+    """
+    Точный поиск соседей перебором по блокам. Поставщик соседей по умолчанию для кластеризации и ранжирования.
+    """
+
+    def __init__(self, max_block_mb: float = 64.0):
+        """
+        * max_block_mb : float
+            Ограничение памяти на один блок матрицы расстояний в мегабайтах (по умолчанию 64).
+        """
+        self.max_block_mb = max_block_mb
+
+    def radius_graph(self, vectors: np.ndarray, radius: float, metric: str = "cosine") -> sp.csr_matrix:
+        """
+        Строит граф соседей в радиусе для DBSCAN(metric="precomputed").
+        * vectors : np.ndarray
+            Матрица векторов размерности (N, D).
+        * radius : float
+            Радиус в метрике metric.
+        * metric : str
+            "cosine" или "euclidean".
+
+        Возвращает:
+        * sp.csr_matrix : Граф расстояний размерности (N, N).
+        """
+        if metric == "cosine":
+            # Граф соседей строится блоками, без матрицы расстояний N x N
+            return cosine_radius_graph(vectors, radius, self.max_block_mb)
+        from sklearn.neighbors import NearestNeighbors
+
+        # С явно переданными точками каждая точка остается своим соседом на расстоянии 0; без них диагональ
+        # дописывает DBSCAN, и порядок строк графа нарушается
+        graph = NearestNeighbors(radius=radius).fit(vectors).radius_neighbors_graph(vectors, mode="distance")
+        return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+    def nearest(self, queries: np.ndarray, points: np.ndarray, metric: str = "cosine") -> tuple[np.ndarray, np.ndarray]:
+        """Ближайшая точка для каждого запроса (см. nearest_neighbor)."""
+        return nearest_neighbor(queries, points, metric, self.max_block_mb)
+
+    def kneighbors(self, vectors: np.ndarray, k: int, metric: str = "cosine") -> tuple[np.ndarray, np.ndarray]:
+        """
+        Находит k ближайших соседей каждой точки (включая ее саму).
+        * vectors : np.ndarray
+            Матрица векторов размерности (N, D).
+        * k : int
+            Число соседей, k <= N.
+        * metric : str
+            "cosine" или "euclidean".
+
+        Возвращает:
+        * np.ndarray : Индексы соседей размерности (N, k) по возрастанию расстояния.
+        * np.ndarray : Расстояния до них размерности (N, k).
+        """
+        X = np.asarray(vectors, dtype=np.float32)
+        if metric == "cosine":
+            X = normalize(X)
+        else:
+            sq = np.einsum("ij,ij->i", X, X)
+        n = X.shape[0]
+        block_size = max(1, int(self.max_block_mb * 2**20 / (4 * max(n, 1))))
+
+        indices = np.empty((n, k), dtype=np.int64)
+        distances = np.empty((n, k), dtype=np.float32)
+        for start in range(0, n, block_size):
+            block = X[start : start + block_size]
+            if metric == "cosine":
+                block_distances = 1.0 - block @ X.T
+            else:
+                block_distances = sq[start : start + len(block), None] - 2 * block @ X.T + sq[None, :]
+            np.maximum(block_distances, 0.0, out=block_distances)
+            # Сама точка всегда первая, даже если у нее есть дубликаты
+            block_distances[np.arange(len(block)), np.arange(start, start + len(block))] = -1.0
+            if k < n:
+                part = np.argpartition(block_distances, k - 1, axis=1)[:, :k]
+            else:
+                part = np.tile(np.arange(n), (len(block), 1))
+            part_distances = np.take_along_axis(block_distances, part, axis=1)
+            order = np.argsort(part_distances, axis=1)
+            indices[start : start + len(block)] = np.take_along_axis(part, order, axis=1)
+            distances[start : start + len(block)] = np.maximum(np.take_along_axis(part_distances, order, axis=1), 0.0)
+
+        if metric != "cosine":
+            distances = np.sqrt(distances)
+        return indices, distances
+
+
+class ANNIndex:
+    """
+    Приближенный индекс ближайших соседей на CPU (NN-descent, pynndescent) для корпусов в десятки тысяч векторов.
+    Точность поиска подбирается по выборке запросов так, чтобы полнота top-k была не ниже recall_target.
+    """
+
+    def __init__(
+        self,
+        metric: str = "cosine",
+        n_neighbors: int = 30,
+        recall_target: float = 0.95,
+        random_state: int = 0,
+        n_jobs: int | None = None,
+    ):
+        """
+        * metric : str
+            "cosine" или "euclidean".
+        * n_neighbors : int
+            Степень графа NN-descent; больше — точнее и дольше построение (по умолчанию 30).
+        * recall_target : float
+            Целевая полнота поиска top-k относительно точного перебора (по умолчанию 0.95).
+        * random_state : int
+            Зерно построения.
+        * n_jobs : int | None
+            Число потоков построения (по умолчанию все ядра).
+        """
+        self.metric = metric
+        self.n_neighbors = n_neighbors
+        self.recall_target = recall_target
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.index = None
+        self.vectors = None
+        self.epsilon = 0.1
+        self.recall = None
+        self.radius_recall = None
+
+    def __len__(self) -> int:
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def build(self, vectors: np.ndarray, calibration_size: int = 256) -> "ANNIndex":
+        """
+        Строит индекс и подбирает точность поиска.
+        * vectors : np.ndarray
+            Векторы размерности (N, D), например эмбеддинги E5Embedder.
+        * calibration_size : int
+            Число запросов для оценки полноты (по умолчанию 256).
+
+        Возвращает:
+        * ANNIndex : self.
+        """
+        from pynndescent import NNDescent  # numba компилирует функции при первом импорте
+
+        self.vectors = vectors = np.asarray(vectors, dtype=np.float32)
+        self.index = NNDescent(
+            vectors,
+            metric=self.metric,
+            n_neighbors=min(self.n_neighbors, len(vectors) - 1),
+            random_state=self.random_state,
+            n_jobs=self.n_jobs,
+            low_memory=True,
+        )
+        # Структуры для поиска строятся сразу, а не при первом запросе
+        self.index.prepare()
+        self.calibrate(vectors, calibration_size)
+        return self
+
+    def calibrate(self, vectors: np.ndarray, sample_size: int = 256, k: int = 10) -> float:
+        """
+        Подбирает наименьший epsilon поиска, при котором полнота top-k на выборке не ниже recall_target.
+        * vectors : np.ndarray
+            Проиндексированные векторы.
+        * sample_size : int
+            Размер выборки запросов.
+        * k : int
+            Число соседей для оценки полноты.
+
+        Возвращает:
+        * float : Достигнутая полнота.
+        """
+        rng = np.random.default_rng(self.random_state)
+        k = min(k, len(vectors))
+        sample = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+        queries = np.asarray(vectors, dtype=np.float32)[sample]
+        exact = _exact_topk(queries, vectors, k, self.metric)
+
+        for epsilon in (0.0, 0.1, 0.2, 0.3, 0.4, 0.6, 0.8):
+            approximate, _ = self.index.query(queries, k=k, epsilon=epsilon)
+            recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(approximate, exact)])
+            self.epsilon, self.recall = epsilon, float(recall)
+            if recall >= self.recall_target:
+                break
+        else:
+            print(f"Полнота ANN-индекса {self.recall:.3f} ниже целевой {self.recall_target}; увеличьте n_neighbors")
+        return self.recall
+
+    def query(self, queries: np.ndarray, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ищет k ближайших проиндексированных векторов для каждого запроса.
+        * queries : np.ndarray
+            Запросы размерности (M, D).
+        * k : int
+            Число соседей.
+
+        Возвращает:
+        * np.ndarray : Индексы соседей размерности (M, k) по возрастанию расстояния.
+        * np.ndarray : Расстояния до них размерности (M, k).
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        indices, distances = self.index.query(queries, k=min(k, len(self)), epsilon=self.epsilon)
+        return indices, np.maximum(distances, 0.0)
+
+    def radius_query(self, queries: np.ndarray, radius: float, max_neighbors: int = 64) -> sp.csr_matrix:
+        """
+        Ищет проиндексированные векторы в радиусе от каждого запроса.
+        Поиск ограничен max_neighbors ближайшими соседями, поэтому в очень плотных областях
+        часть соседей в радиусе может быть не найдена; полнота поиска в радиусе оценивается
+        отдельно от top-k (см. calibrate_radius). Если max_neighbors не меньше размера индекса,
+        соседи ищутся точным перебором.
+        * queries : np.ndarray
+            Запросы размерности (M, D).
+        * radius : float
+            Радиус в метрике индекса.
+        * max_neighbors : int
+            Наибольшее число соседей на запрос (по умолчанию 64).
+
+        Возвращает:
+        * sp.csr_matrix : Матрица (M, N) с расстояниями до соседей в радиусе (явные нули сохраняются).
+        """
+        if max_neighbors >= len(self):
+            distances = _exact_distances(queries, self.vectors, self.metric)
+            rows, cols = np.nonzero(distances <= radius)
+            graph = sp.coo_matrix((distances[rows, cols], (rows, cols)), shape=distances.shape).tocsr()
+        else:
+            indices, distances = self.query(queries, max_neighbors)
+            rows, cols = np.nonzero(distances <= radius)
+            graph = sp.coo_matrix(
+                (distances[rows, cols], (rows, indices[rows, cols])), shape=(len(indices), len(self))
+            ).tocsr()
+        return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+    def calibrate_radius(self, radius: float, max_neighbors: int = 64, sample_size: int = 256) -> float:
+        """
+        Оценивает полноту поиска в радиусе: долю соседей в радиусе по точному перебору, которые находит
+        radius_query. Полнота top-k из calibrate ее не гарантирует: соседей в радиусе может быть больше
+        max_neighbors, а ошибки NN-descent на дальних соседях top-10 не видны.
+        * radius : float
+            Радиус в метрике индекса.
+        * max_neighbors : int
+            Наибольшее число соседей на запрос.
+        * sample_size : int
+            Размер выборки запросов.
+
+        Возвращает:
+        * float : Полнота от 0 до 1 (1, если в радиусе нет соседей).
+        """
+        rng = np.random.default_rng(self.random_state)
+        sample = rng.choice(len(self), min(sample_size, len(self)), replace=False)
+        queries = self.vectors[sample]
+        exact = _exact_distances(queries, self.vectors, self.metric) <= radius
+        found = self.radius_query(queries, radius, max_neighbors)
+        total = int(exact.sum())
+        self.radius_recall = float(found.nnz / total) if total else 1.0
+        if self.radius_recall < self.recall_target:
+            print(
+                f"Полнота поиска ANN в радиусе {radius:.3f} равна {self.radius_recall:.3f}, "
+                f"ниже целевой {self.recall_target}"
+            )
+        return self.radius_recall
+
+    def radius_graph(self, radius: float, max_neighbors: int = 64) -> sp.csr_matrix:
+        """
+        Строит симметричный граф соседей в радиусе для проиндексированных векторов.
+        Полнота графа оценивается по выборке точек и сохраняется в radius_recall; если она ниже
+        recall_target, граф строится точным перебором.
+        * radius : float
+            Радиус в метрике индекса.
+        * max_neighbors : int
+            Наибольшее число соседей на точку (должно быть не меньше min_samples DBSCAN).
+
+        Возвращает:
+        * sp.csr_matrix : Граф расстояний размерности (N, N).
+        """
+        if max_neighbors < len(self) and self.calibrate_radius(radius, max_neighbors) < self.recall_target:
+            print("Граф соседей строится точным перебором")
+            return ExactNeighbors().radius_graph(self.vectors, radius, self.metric)
+        graph = self.radius_query(self.vectors, radius, max_neighbors).tocoo()
+        return _symmetric_csr(graph.row, graph.col, graph.data, len(self))
+
+    def save(self, path: str) -> None:
+        """Сохраняет индекс вместе с подобранной точностью поиска."""
+        import joblib
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        joblib.dump(self, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str) -> "ANNIndex":
+        """Загружает сохраненный индекс."""
+        import joblib
+
+        return joblib.load(path)
+
+
+def _exact_distances(queries: np.ndarray, points: np.ndarray, metric: str) -> np.ndarray:
+    """Матрица расстояний от запросов до точек точным перебором (в тех же единицах, что у pynndescent)."""
+    Q, P = np.asarray(queries, dtype=np.float32), np.asarray(points, dtype=np.float32)
+    if metric == "cosine":
+        distances = 1.0 - normalize(Q) @ normalize(P).T
+    else:
+        distances = np.einsum("ij,ij->i", Q, Q)[:, None] - 2 * Q @ P.T + np.einsum("ij,ij->i", P, P)[None, :]
+    np.maximum(distances, 0.0, out=distances)
+    return distances if metric == "cosine" else np.sqrt(distances)
+
+
+def _exact_topk(queries: np.ndarray, points: np.ndarray, k: int, metric: str) -> np.ndarray:
+    """Индексы k ближайших точек для каждого запроса точным перебором (для оценки полноты)."""
+    Q, P = np.asarray(queries, dtype=np.float32), np.asarray(points, dtype=np.float32)
+    if metric == "cosine":
+        distances = 1.0 - normalize(Q) @ normalize(P).T
+    else:
+        distances = -2 * Q @ P.T + np.einsum("ij,ij->i", P, P)[None, :]
+    if k >= P.shape[0]:
+        return np.tile(np.arange(P.shape[0]), (len(Q), 1))
+    return np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+
+class ApproximateNeighbors:
+    """
+    Поставщик соседей на основе ANNIndex: тот же интерфейс, что у ExactNeighbors,
+    но граф в радиусе строится по max_neighbors приближенным ближайшим соседям каждой точки.
+    """
+
+    def __init__(
+        self, max_neighbors: int = 64, n_neighbors: int = 30, recall_target: float = 0.95, random_state: int = 0
+    ):
+        """
+        * max_neighbors : int
+            Наибольшее число соседей на точку в графе (должно быть не меньше min_samples DBSCAN).
+        * n_neighbors, recall_target, random_state
+            Параметры ANNIndex.
+        """
+        self.max_neighbors = max_neighbors
+        self.n_neighbors = n_neighbors
+        self.recall_target = recall_target
+        self.random_state = random_state
+
+    def build_index(self, vectors: np.ndarray, metric: str = "cosine") -> ANNIndex:
+        """Строит ANNIndex по векторам."""
+        index = ANNIndex(metric, self.n_neighbors, self.recall_target, self.random_state)
+        return index.build(vectors)
+
+    def radius_graph(self, vectors: np.ndarray, radius: float, metric: str = "cosine") -> sp.csr_matrix:
+        """
+        Граф соседей в радиусе (см. ExactNeighbors.radius_graph).
+        Если точек не больше max_neighbors, приближенный поиск ничего не экономит, и граф строится точно.
+        """
+        if len(vectors) <= self.max_neighbors:
+            return ExactNeighbors().radius_graph(vectors, radius, metric)
+        return self.build_index(vectors, metric).radius_graph(radius, self.max_neighbors)
+
+    def nearest(self, queries: np.ndarray, points: np.ndarray, metric: str = "cosine") -> tuple[np.ndarray, np.ndarray]:
+        """Ближайшая точка для каждого запроса (см. nearest_neighbor)."""
+        indices, distances = self.build_index(points, metric).query(queries, k=1)
+        return indices[:, 0], distances[:, 0]
+
+    def kneighbors(self, vectors: np.ndarray, k: int, metric: str = "cosine") -> tuple[np.ndarray, np.ndarray]:
+        """k ближайших соседей каждой точки (см. ExactNeighbors.kneighbors)."""
+        return self.build_index(vectors, metric).query(vectors, k)
+
+
+def get_neighbor_provider(name: str = "exact", **kwargs):
+    """
+    Возвращает поставщика соседей по названию.
+    * name : str
+        "exact" (ExactNeighbors) или "ann" (ApproximateNeighbors).
+    * kwargs
+        Параметры конструктора.
+
+    Возвращает:
+    * ExactNeighbors | ApproximateNeighbors : Поставщик соседей.
+    """
+    providers = {"exact": ExactNeighbors, "ann": ApproximateNeighbors}
+    if name not in providers:
+        raise ValueError(f"Неизвестный поставщик соседей: {name!r}")
+    return providers[name](**kwargs)
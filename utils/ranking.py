@@ -1,32 +1,189 @@
+import threading
+import time
 import typing as tp
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
 from datasketch import MinHash, MinHashLSH
-from transformers import BertTokenizer
-from umap import UMAP
+from scipy.sparse.linalg import eigsh
+from sklearn.preprocessing import normalize
 
-from utils.embedder import E5Embedder
+from utils.embedder import E5Embedder, get_embedder
+from utils.neighbors import ExactNeighbors, get_neighbor_provider
+from utils.resources import load_bert_tokenizer
 
 # Suppress the UMAP warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="umap.umap_")
 
 
+def _estimated_jaccard_edges(
+    hashvalues: np.ndarray, min_similarity: float, max_block_mb: float = 64.0
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Оценивает сходство Жаккара всех пар строк как долю совпавших значений MinHash.
+    * hashvalues : np.ndarray
+        Матрица значений MinHash размерности (N, num_perm).
+    * min_similarity : float
+        Пары с меньшим сходством отбрасываются.
+    * max_block_mb : float
+        Ограничение памяти на блок сравнений в мегабайтах.
+
+    Возвращает:
+    * np.ndarray, np.ndarray : Индексы пар i < j.
+    * np.ndarray : Оценки сходства пар.
+    """
+    n, num_perm = hashvalues.shape
+    block_size = max(1, int(max_block_mb * 2**20 / max(n * num_perm, 1)))
+    rows, cols, values = [], [], []
+    for start in range(0, n, block_size):
+        block = hashvalues[start : start + block_size]
+        similarity = (block[:, None, :] == hashvalues[None, :, :]).mean(axis=2)
+        r, c = np.nonzero(similarity >= min_similarity)
+        r += start
+        upper = r < c
+        rows.append(r[upper])
+        cols.append(c[upper])
+        values.append(similarity[r[upper] - start, c[upper]])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+class _UnionFind:
+    """Система непересекающихся множеств с отслеживанием размера наибольшего множества."""
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.largest = 1 if n else 0
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.largest = max(self.largest, self.size[i])
+
+
+# Параметры универсального хэширования MinHash (как в datasketch)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Кэш множеств токенов по нормализованной строке: одни и те же комментарии ранжируются многократно
+TOKEN_CACHE_SIZE = 50_000
+_token_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _permutations(num_perm: int) -> np.ndarray:
+    """Параметры перестановок (a, b) размерности (2, num_perm), совпадающие с MinHash(num_perm) из datasketch."""
+    return MinHash(num_perm=num_perm).permutations
+
+
+def token_sets(strings: tp.List[str], tokenizer) -> tp.List[np.ndarray]:
+    """
+    Множества идентификаторов токенов для строк. Отсутствующие в кэше строки токенизируются одним батчем.
+    * strings : list[str]
+        Строки.
+    * tokenizer : PreTrainedTokenizerFast
+        Токенизатор.
+
+    Возвращает:
+    * list[np.ndarray] : Уникальные идентификаторы токенов каждой строки (uint64).
+    """
+    keys = [" ".join(s.split()) for s in strings]
+    found = {}
+    with _token_cache_lock:
+        for key in keys:
+            if key in _token_cache:
+                _token_cache.move_to_end(key)
+                found[key] = _token_cache[key]
+
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if missing:
+        # Быстрый токенизатор нельзя вызывать из нескольких потоков одновременно, поэтому вызов под блокировкой
+        with _token_cache_lock:
+            input_ids = tokenizer(missing, add_special_tokens=False)["input_ids"]
+            for key, ids in zip(missing, input_ids):
+                found[key] = _token_cache[key] = np.unique(np.asarray(ids, dtype=np.uint64))
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return [found[key] for key in keys]
+
+
+def minhash_signatures(sets: tp.List[np.ndarray], num_perm: int = 128) -> np.ndarray:
+    """
+    Строит сигнатуры MinHash всех множеств сразу: хэши всех токенов считаются одной матричной операцией,
+    а минимум по токенам каждой строки — через np.minimum.reduceat.
+    * sets : list[np.ndarray]
+        Множества идентификаторов токенов (uint64).
+    * num_perm : int
+        Число перестановок (по умолчанию 128).
+
+    Возвращает:
+    * np.ndarray : Матрица сигнатур размерности (N, num_perm), uint64; у пустых множеств все значения максимальны.
+    """
+    a, b = _permutations(num_perm)
+    lengths = np.array([len(tokens) for tokens in sets], dtype=int)
+    signatures = np.full((len(sets), num_perm), _MAX_HASH, dtype=np.uint64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        tokens = np.concatenate([tokens for tokens in sets if len(tokens)])
+        # Переполнение uint64 при умножении ожидаемо, как и в datasketch
+        hashed = np.bitwise_and((tokens[:, None] * a[None, :] + b[None, :]) % _MERSENNE_PRIME, _MAX_HASH)
+        offsets = np.concatenate([[0], np.cumsum(lengths[nonempty])[:-1]])
+        signatures[nonempty] = np.minimum.reduceat(hashed, offsets, axis=0)
+    return signatures
+
+
 class PreClustering:
     """
     Класс для предварительной кластеризации строк с использованием LSH и MinHash.
     """
 
-    def __init__(self, lowercase_strings: tp.List[str]):
+    ENGINES = ("sweep", "lsh")
+
+    def __init__(self, lowercase_strings: tp.List[str], engine: str = "sweep"):
         """
         Инициализирует класс с заданными строками и параметрами.
         * lowercase_strings : list[str]
             Список строк в нижнем регистре.
+        * engine : str
+            "sweep" — один проход по оценкам сходства Жаккара всех пар с union-find (sweep_cluster);
+            "lsh" — пошаговый подбор порога с индексом MinHashLSH (LSH_cluster). По умолчанию "sweep".
         """
+        if engine not in self.ENGINES:
+            raise ValueError(f"Неизвестный способ предварительной кластеризации: {engine!r}")
         self.lowercase_strings = lowercase_strings
+        self.engine = engine
+        self.MIN_THRESH = 0.2
         self.MAX_THRESH = 0.97
-        self.tokenizer = BertTokenizer.from_pretrained("sberbank-ai/ruBert-base", clean_up_tokenization_spaces=True)
+        self.MAX_COMPONENT_SHARE = 0.4
+        self.tokenizer = load_bert_tokenizer()
+
+    def _signatures(self, strings: tp.List[str]) -> np.ndarray:
+        """Матрица сигнатур MinHash множеств токенов строк размерности (N, 128)."""
+        return minhash_signatures(token_sets(strings, self.tokenizer), num_perm=128)
+
+    def _min_hashes(self, strings: tp.List[str]) -> tp.List[MinHash]:
+        """Объекты MinHash для индекса MinHashLSH, построенные из общей матрицы сигнатур."""
+        permutations = _permutations(128)
+        return [
+            MinHash(num_perm=128, hashvalues=row, permutations=permutations) for row in self._signatures(strings)
+        ]
 
     def LSH_cluster(self, strings: tp.List[str]) -> tp.Tuple[tp.List[tp.List[int]], tp.List[int]]:
         """
@@ -43,26 +200,19 @@ class PreClustering:
         if len(strings) < 5:
             return [], list(range(len(strings)))
 
-        min_hashes = []
-        for s in strings:
-            m = MinHash(num_perm=128)
-            for word in set(self.tokenizer.tokenize(s)):
-                m.update(word.encode("utf8"))
-            min_hashes.append(m)
+        min_hashes = self._min_hashes(strings)
 
-        prev_threshold, prev_num_edges = 0.2, np.inf
-        threshold = 0.2 + len(strings) / 1600
+        prev_threshold, prev_num_edges = self.MIN_THRESH, np.inf
+        threshold = self.MIN_THRESH + len(strings) / 1600
         combo, tried_backtrack = 0, False
 
         while True:
-            close_nodes = []
-            for i, min_hash in enumerate(min_hashes):
-                lsh = MinHashLSH(threshold=threshold, num_perm=128)
-                for j, mh in enumerate(min_hashes):
-                    if i != j:
-                        lsh.insert(j, mh)
-                group = [i] + lsh.query(min_hash)
-                close_nodes.append(group)
+            # Один индекс на порог: каждая строка вставляется один раз, затем все строки ищутся в общем индексе.
+            # Результат совпадает с индексом из всех строк, кроме i: коллизии бакетов не зависят от других строк
+            lsh = MinHashLSH(threshold=threshold, num_perm=128)
+            for j, mh in enumerate(min_hashes):
+                lsh.insert(j, mh)
+            close_nodes = [[i] + [j for j in lsh.query(min_hash) if j != i] for i, min_hash in enumerate(min_hashes)]
 
             # Построение графа и определение компонент
             pairs = [(clust[i], clust[i + 1]) for clust in close_nodes for i in range(len(clust) - 1)]
@@ -85,7 +235,8 @@ class PreClustering:
             else:
                 combo = 0
 
-            if max(len(comp) for comp in nx.connected_components(G)) > int(0.4 * len(strings)) and combo < 4:
+            max_component = int(self.MAX_COMPONENT_SHARE * len(strings))
+            if max(len(comp) for comp in nx.connected_components(G)) > max_component and combo < 4:
                 prev_threshold = threshold
                 if threshold != self.MAX_THRESH:
                     threshold += 0.01 * (num_edges / len(strings))
@@ -101,6 +252,68 @@ class PreClustering:
 
         return clusters, outcasts
 
+    def sweep_cluster(self, strings: tp.List[str]) -> tp.Tuple[tp.List[tp.List[int]], tp.List[int]]:
+        """
+        Кластеризует строки за один проход по порогам.
+        Сходство Жаккара всех пар оценивается сразу по матрице значений MinHash, ребра сортируются
+        по убыванию сходства и добавляются в union-find; так для каждого порога известен размер
+        наибольшей компоненты. Выбирается наименьший порог не ниже стартового (как в LSH_cluster),
+        при котором наибольшая компонента не превышает MAX_COMPONENT_SHARE строк.
+        * strings : list[str]
+            Список текстовых строк.
+
+        Возвращает:
+        * clusters : list[list[int]]
+            Список кластеров (список списков индексов).
+        * outcasts : list[int]
+            Список индексов выбросов.
+        """
+        n = len(strings)
+        if n < 5:
+            return [], list(range(n))
+
+        hashvalues = self._signatures(strings)
+        rows, cols, similarity = _estimated_jaccard_edges(hashvalues, self.MIN_THRESH)
+        if len(similarity) == 0:
+            return [], list(range(n))
+        order = np.argsort(-similarity, kind="stable")
+        rows, cols, similarity = rows[order], cols[order], similarity[order]
+
+        # Оценки сходства кратны 1/num_perm, поэтому ребра с одинаковым сходством добавляются пачкой
+        ends = np.append(np.flatnonzero(np.diff(similarity)) + 1, len(similarity))
+        cap = int(self.MAX_COMPONENT_SHARE * n)
+        start_threshold = min(self.MIN_THRESH + n / 1600, self.MAX_THRESH)
+
+        if similarity[0] < start_threshold:
+            # Как при откате в LSH_cluster: при стартовом пороге ребер нет — берем наибольший порог с ребрами
+            threshold = similarity[0]
+        else:
+            union_find, begin, threshold, previous = _UnionFind(n), 0, start_threshold, None
+            for end in ends:
+                value = similarity[begin]
+                if value < start_threshold:
+                    # Компоненты при стартовом пороге уже допустимы
+                    break
+                for i, j in zip(rows[begin:end], cols[begin:end]):
+                    union_find.union(i, j)
+                if union_find.largest > cap:
+                    # С ребрами этого сходства компонента слишком велика: берем предыдущий порог (не выше MAX_THRESH)
+                    threshold = min(previous, self.MAX_THRESH) if previous is not None else self.MAX_THRESH
+                    break
+                previous, begin = value, end
+
+        # Компоненты при выбранном пороге
+        keep = similarity >= threshold
+        union_find = _UnionFind(n)
+        for i, j in zip(rows[keep], cols[keep]):
+            union_find.union(i, j)
+        connected = np.zeros(n, dtype=bool)
+        connected[rows[keep]] = connected[cols[keep]] = True
+        roots = np.array([union_find.find(i) for i in range(n)])
+        clusters = [np.flatnonzero((roots == root) & connected).tolist() for root in np.unique(roots[connected])]
+        outcasts = np.flatnonzero(~connected).tolist()
+        return clusters, outcasts
+
     def get_clustering(self) -> tp.Tuple[tp.List[tp.List[int]], tp.List[int]]:
         """
         Получает результаты кластеризации.
@@ -111,6 +324,8 @@ class PreClustering:
         * outcasts : list[int]
             Список выбросов.
         """
+        if self.engine == "sweep":
+            return self.sweep_cluster(self.lowercase_strings)
         return self.LSH_cluster(self.lowercase_strings)
 
 
@@ -119,27 +334,143 @@ class Ranker:
     Класс для ранжирования строк с использованием эмбеддингов и кластеризации.
     """
 
-    def __init__(self):
-        """Инициализирует эмбеддер и пороговое значение для объема LSH."""
-        self.e5_embedder = E5Embedder()
+    ENGINES = ("pca", "spectral", "chain", "umap")
+
+    def __init__(
+        self,
+        e5_embedder: tp.Optional[E5Embedder] = None,
+        neighbors: tp.Any = None,
+        engine: str = "pca",
+        n_jobs: int = 1,
+        random_state: tp.Optional[int] = 0,
+    ):
+        """
+        Инициализирует эмбеддер и пороговое значение для объема LSH.
+        * e5_embedder : E5Embedder | None
+            Эмбеддер; если не передан, при первом обращении берется общий для процесса экземпляр из get_embedder().
+        * neighbors : str | ExactNeighbors | ApproximateNeighbors | None
+            Поставщик соседей для графов kNN ("exact", "ann" или готовый объект); по умолчанию точный перебор,
+            а UMAP ищет соседей сам.
+        * engine : str
+            Способ упорядочивания: "pca" (первая главная компонента), "spectral" (вектор Фидлера косинусного
+            графа kNN), "chain" (жадная цепочка ближайших соседей) или "umap" (одномерный UMAP, медленно).
+            По умолчанию "pca".
+        * n_jobs : int
+            Число потоков для параллельного ранжирования кластеров в rank_all (по умолчанию 1).
+        * random_state : int | None
+            Зерно для стохастических способов (UMAP), чтобы порядок был воспроизводимым; None — без зерна.
+        """
+        if engine not in self.ENGINES:
+            raise ValueError(f"Неизвестный способ упорядочивания: {engine!r}")
+        self._e5_embedder = e5_embedder
+        self.neighbors = get_neighbor_provider(neighbors) if isinstance(neighbors, str) else neighbors
+        self.engine = engine
+        self.n_jobs = n_jobs
+        self.random_state = random_state
         self.LSH_volume_thresh = 48
+        # Кластеры меньшего размера упорядочиваются векторизованно, без PreClustering и движка
+        self.small_cluster_size = 5
+        self.umap_neighbors = 15
+        self.spectral_neighbors = 10
+        # Время упорядочивания по способам: engine -> список длительностей в секундах
+        self.timings: tp.Dict[str, tp.List[float]] = {}
+
+    @property
+    def e5_embedder(self) -> E5Embedder:
+        """Эмбеддер; модель загружается только тогда, когда эмбеддинги действительно нужно посчитать."""
+        if self._e5_embedder is None:
+            self._e5_embedder = get_embedder()
+        return self._e5_embedder
 
-    def rank(self, strings: tp.List[str]) -> np.ndarray:
+    def timing_summary(self) -> tp.Dict[str, tp.Dict[str, float]]:
         """
-        Ранжирует строки на основе эмбеддингов и UMAP.
-        * strings : list[str]
-            Список строк для ранжирования.
+        Сводка времени упорядочивания по способам.
 
         Возвращает:
-        * np.ndarray : Индексы строк в порядке ранжирования.
+        * dict[str, dict[str, float]] : Для каждого способа число упорядоченных кластеров (calls),
+          суммарное и среднее время на кластер.
         """
-        if len(strings) < 3:
-            return np.arange(len(strings))
+        return {
+            engine: {"calls": len(times), "total_s": float(np.sum(times)), "mean_ms": float(np.mean(times) * 1000)}
+            for engine, times in self.timings.items()
+        }
 
-        strings = [str(s).lower() for s in strings]
-        embeddings = self.e5_embedder.get_embeddings(strings)
+    @staticmethod
+    def _pca_order(embeddings: np.ndarray) -> np.ndarray:
+        """Координата каждой строки на первой главной компоненте эмбеддингов."""
+        X = np.asarray(embeddings, dtype=np.float32)
+        X = X - X.mean(axis=0)
+        _, _, vt = np.linalg.svd(X, full_matrices=False)
+        component = vt[0]
+        # Знак компоненты фиксируется, чтобы порядок не переворачивался между запусками
+        if component[np.argmax(np.abs(component))] < 0:
+            component = -component
+        return X @ component
+
+    def _spectral_order(self, embeddings: np.ndarray) -> np.ndarray:
+        """Координата каждой строки в векторе Фидлера нормированного лапласиана косинусного графа kNN."""
+        n = len(embeddings)
+        k = min(self.spectral_neighbors + 1, n)
+        neighbors = self.neighbors if self.neighbors is not None else ExactNeighbors()
+        indices, distances = neighbors.kneighbors(embeddings, k, metric="cosine")
+
+        rows = np.repeat(np.arange(n), indices.shape[1])
+        weights = np.clip(1.0 - distances.ravel(), 1e-6, None)
+        W = sp.coo_matrix((weights, (rows, indices.ravel())), shape=(n, n)).tocsr()
+        W = W.maximum(W.T)
+        W = (W - sp.diags(W.diagonal())).tocsr()
+        degree = np.asarray(W.sum(axis=1)).ravel()
+        d_inv_sqrt = 1.0 / np.sqrt(np.maximum(degree, 1e-12))
+        M = sp.diags(d_inv_sqrt) @ W @ sp.diags(d_inv_sqrt)
+
+        # Второй по величине собственный вектор D^-1/2 W D^-1/2 соответствует вектору Фидлера
+        if n <= 500:
+            _, vectors = np.linalg.eigh(M.toarray())
+            fiedler = vectors[:, -2]
+        else:
+            _, vectors = eigsh(M, k=2, which="LA", v0=np.ones(n))
+            fiedler = vectors[:, 0]
+        fiedler = fiedler * d_inv_sqrt
+        if fiedler[np.argmax(np.abs(fiedler))] < 0:
+            fiedler = -fiedler
+        return fiedler
+
+    @staticmethod
+    def _chain_order(embeddings: np.ndarray) -> np.ndarray:
+        """
+        Позиция каждой строки в жадной цепочке: от самой удаленной от центра строки
+        каждый раз переходим к ближайшей еще не пройденной по косинусному сходству.
+        """
+        X = normalize(np.asarray(embeddings, dtype=np.float32))
+        n = len(X)
+        similarity = X @ X.T
+        current = int(np.argmin(X @ X.mean(axis=0)))
+        visited = np.zeros(n, dtype=bool)
+        position = np.empty(n, dtype=np.float64)
+        for step in range(n):
+            visited[current] = True
+            position[current] = step
+            if step == n - 1:
+                break
+            candidates = np.where(visited, -np.inf, similarity[current])
+            current = int(np.argmax(candidates))
+        return position
+
+    def _umap_order(self, strings: tp.List[str], embeddings: np.ndarray) -> tp.Optional[np.ndarray]:
+        """Одномерный UMAP эмбеддингов, для небольших кластеров — в сочетании с UMAP признаков LSH."""
+        from umap import UMAP  # numba компилирует UMAP при первом импорте, поэтому он загружается только по запросу
 
-        fit_embeddings = UMAP(n_components=1).fit(embeddings)
+        if self.neighbors is not None and len(strings) > self.LSH_volume_thresh:
+            # Граф соседей для UMAP берется у поставщика (например, приближенного индекса для больших кластеров)
+            k = min(self.umap_neighbors, len(strings))
+            knn_indices, knn_dists = self.neighbors.kneighbors(embeddings, k, metric="euclidean")
+            fit_embeddings = UMAP(
+                n_components=1, n_neighbors=k, precomputed_knn=(knn_indices, knn_dists, None),
+                random_state=self.random_state,
+            )
+            fit_embeddings = fit_embeddings.fit(embeddings)
+        else:
+            fit_embeddings = UMAP(n_components=1, random_state=self.random_state).fit(embeddings)
 
         if len(strings) <= self.LSH_volume_thresh:
             clusters, _ = PreClustering(strings).get_clustering()
@@ -151,13 +482,144 @@ class Ranker:
             # Проверка, что признаки кластеров не пустые
             if cluster_features.shape[1] == 0:
                 print("Признаки кластеров пусты. Не удается выполнить кластеризацию.")
-                # Возвращаем пустую структуру и подпись
-                return np.arange(len(strings))  
-            fit_clusters = UMAP(n_components=1, metric="jaccard").fit(cluster_features)
+                return None
+            fit_clusters = UMAP(n_components=1, metric="jaccard", random_state=self.random_state).fit(cluster_features)
             fit_intersection = fit_embeddings * fit_clusters
-            reduced = fit_intersection.embedding_.ravel()
-        else:
-            reduced = fit_embeddings.embedding_.ravel()
+            return fit_intersection.embedding_.ravel()
+        return fit_embeddings.embedding_.ravel()
+
+    def _group_order(self, strings: tp.List[str], coordinate: np.ndarray) -> np.ndarray:
+        """
+        Порядок с учетом групп почти одинаковых строк (PreClustering): группы идут по средней координате,
+        строки внутри группы — по своей координате, поэтому лексические дубликаты оказываются рядом.
+        """
+        clusters, _ = PreClustering(strings).get_clustering()
+        group = np.arange(len(strings)) + len(clusters)
+        for i, cluster in enumerate(clusters):
+            group[cluster] = i
+        _, group = np.unique(group, return_inverse=True)
+        group_coordinate = np.bincount(group, weights=coordinate) / np.bincount(group)
+        return np.lexsort((coordinate, group_coordinate[group]))
+
+    def rank(self, strings: tp.List[str], embeddings: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Ранжирует строки, упорядочивая их эмбеддинги вдоль одной оси выбранным способом (engine).
+        * strings : list[str]
+            Список строк для ранжирования.
+        * embeddings : np.ndarray | None
+            Готовые эмбеддинги строк (например, полученные при кластеризации); если не переданы, вычисляются заново.
+
+        Возвращает:
+        * np.ndarray : Индексы строк в порядке ранжирования.
+        """
+        if len(strings) < 3:
+            return np.arange(len(strings))
 
-        order = np.argsort(reduced)
+        strings = [str(s).lower() for s in strings]
+        if embeddings is None:
+            embeddings = self.e5_embedder.get_embeddings(strings)
+        elif len(embeddings) != len(strings):
+            raise ValueError("Количество эмбеддингов не совпадает с количеством строк")
+
+        start = time.perf_counter()
+        if self.engine == "umap":
+            reduced = self._umap_order(strings, embeddings)
+            order = np.argsort(reduced) if reduced is not None else np.arange(len(strings))
+        else:
+            if self.engine == "pca":
+                coordinate = self._pca_order(embeddings)
+            elif self.engine == "spectral":
+                coordinate = self._spectral_order(embeddings)
+            else:
+                coordinate = self._chain_order(embeddings)
+            if len(strings) <= self.LSH_volume_thresh:
+                order = self._group_order(strings, coordinate)
+            else:
+                order = np.argsort(coordinate, kind="stable")
+        self.timings.setdefault(self.engine, []).append(time.perf_counter() - start)
         return order
+
+    @staticmethod
+    def _centroid_order(labels: np.ndarray, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Упорядочивает строки всех переданных кластеров сразу: внутри кластера — по убыванию
+        косинусного сходства с центром кластера (сначала самые типичные комментарии).
+        * labels : np.ndarray
+            Метки кластеров строк.
+        * embeddings : np.ndarray
+            Эмбеддинги строк.
+
+        Возвращает:
+        * np.ndarray : Индексы строк, сгруппированные по возрастанию метки.
+        """
+        X = normalize(np.asarray(embeddings, dtype=np.float32))
+        _, groups = np.unique(labels, return_inverse=True)
+        centroids = np.zeros((groups.max() + 1, X.shape[1]), dtype=np.float32)
+        np.add.at(centroids, groups, X)
+        similarity = np.einsum("ij,ij->i", X, normalize(centroids)[groups])
+        # Стабильная сортировка: при равном сходстве сохраняется исходный порядок
+        return np.lexsort((np.arange(len(X)), -similarity, groups))
+
+    def rank_all(
+        self,
+        strings: tp.List[str],
+        labels: tp.Sequence[int],
+        embeddings: tp.Optional[np.ndarray] = None,
+        n_jobs: tp.Optional[int] = None,
+    ) -> tp.Dict[int, np.ndarray]:
+        """
+        Ранжирует строки внутри каждого кластера задачи за один вызов.
+        Небольшие кластеры (меньше small_cluster_size строк) упорядочиваются одним векторизованным проходом,
+        остальные — методом rank параллельно в пуле потоков. Результат не зависит от порядка завершения задач.
+        * strings : list[str]
+            Все строки задачи.
+        * labels : Sequence[int]
+            Метка кластера каждой строки.
+        * embeddings : np.ndarray | None
+            Эмбеддинги всех строк; если не переданы, вычисляются одним батчем.
+        * n_jobs : int | None
+            Число потоков; по умолчанию self.n_jobs.
+
+        Возвращает:
+        * dict[int, np.ndarray] : Для каждой метки — индексы ее строк (в нумерации strings) в порядке ранжирования.
+        """
+        labels = np.asarray(labels)
+        if len(labels) != len(strings):
+            raise ValueError("Количество меток не совпадает с количеством строк")
+        if embeddings is None:
+            embeddings = self.e5_embedder.get_embeddings([str(s).lower() for s in strings])
+        elif len(embeddings) != len(strings):
+            raise ValueError("Количество эмбеддингов не совпадает с количеством строк")
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+
+        cluster_ids, counts = np.unique(labels, return_counts=True)
+        members = {label: np.flatnonzero(labels == label) for label in cluster_ids}
+        orders: tp.Dict[int, np.ndarray] = {}
+
+        # Небольшие кластеры — одним проходом
+        small = np.isin(labels, cluster_ids[counts < self.small_cluster_size])
+        if small.any():
+            start = time.perf_counter()
+            small_ids = cluster_ids[counts < self.small_cluster_size]
+            indices = np.flatnonzero(small)
+            ordered = indices[self._centroid_order(labels[small], embeddings[small])]
+            for label in small_ids:
+                orders[int(label)] = ordered[labels[ordered] == label]
+            # Время общего прохода делится поровну между кластерами, чтобы сводка считала кластеры, а не вызовы
+            elapsed = time.perf_counter() - start
+            self.timings.setdefault("small", []).extend([elapsed / len(small_ids)] * len(small_ids))
+
+        large = [int(label) for label in cluster_ids[counts >= self.small_cluster_size]]
+
+        def rank_cluster(label: int) -> np.ndarray:
+            indices = members[label]
+            return indices[self.rank([strings[i] for i in indices], embeddings=embeddings[indices])]
+
+        if n_jobs > 1 and len(large) > 1:
+            # numpy/scipy отпускают GIL в линейной алгебре, поэтому потоков достаточно и данные не копируются
+            with ThreadPoolExecutor(min(n_jobs, len(large))) as executor:
+                ranked = list(executor.map(rank_cluster, large))
+        else:
+            ranked = [rank_cluster(label) for label in large]
+        orders.update(zip(large, ranked))
+        return {int(label): orders[int(label)] for label in cluster_ids}
@@ -0,0 +1,119 @@
+"""
+Локальные ресурсы моделей: стоп-слова NLTK, токенизаторы и веса HuggingFace.
+
+Однократная подготовка ресурсов (требует доступа в сеть):
+    python -m utils.resources
+
+После этого код загружает ресурсы только из локальной папки (RESOURCE_DIR),
+лениво и не более одного раза за процесс; без подготовленных моделей загрузка завершается ошибкой.
+"""
+
+import os
+import threading
+from functools import lru_cache
+
+# Папка с ресурсами; можно переопределить переменной окружения
+RESOURCE_DIR = os.environ.get("CLUSTERING_RESOURCES", "resources")
+NLTK_DIR = os.path.join(RESOURCE_DIR, "nltk_data")
+HF_DIR = os.path.join(RESOURCE_DIR, "hf")
+
+NLTK_PACKAGES = ("stopwords", "punkt", "punkt_tab")
+BERT_TOKENIZER_NAME = "sberbank-ai/ruBert-base"
+HF_MODELS = ("intfloat/multilingual-e5-small",)
+
+_nltk_lock = threading.Lock()
+_nltk_configured = False
+
+
+def _configure_nltk() -> None:
+    """Добавляет локальную папку ресурсов в пути поиска NLTK."""
+    global _nltk_configured
+    with _nltk_lock:
+        if not _nltk_configured:
+            import nltk
+
+            if os.path.abspath(NLTK_DIR) not in nltk.data.path:
+                nltk.data.path.insert(0, os.path.abspath(NLTK_DIR))
+            _nltk_configured = True
+
+
+def resolve_model_path(name: str) -> str:
+    """
+    Возвращает путь к локальной копии модели HuggingFace.
+    Модель из сети не скачивается: если копия не подготовлена, выбрасывается исключение.
+    * name : str
+        Название модели на HuggingFace Hub или путь к папке с моделью.
+
+    Возвращает:
+    * str : Локальный путь к модели.
+    """
+    if os.path.isdir(name):
+        return name
+    local_path = os.path.join(HF_DIR, name.replace("/", "__"))
+    if not os.path.isdir(local_path):
+        raise FileNotFoundError(
+            f"Модель {name} не найдена в {os.path.abspath(HF_DIR)}; "
+            "подготовьте ресурсы командой python -m utils.resources"
+        )
+    return local_path
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(language: str = "russian") -> tuple[str, ...]:
+    """
+    Загружает список стоп-слов NLTK (один раз за процесс).
+    * language : str
+        Язык (по умолчанию "russian").
+
+    Возвращает:
+    * tuple[str, ...] : Стоп-слова.
+    """
+    _configure_nltk()
+    from nltk.corpus import stopwords
+
+    return tuple(stopwords.words(language))
+
+
+@lru_cache(maxsize=None)
+def load_bert_tokenizer(name: str = BERT_TOKENIZER_NAME):
+    """
+    Загружает быстрый (на Rust) токенизатор BERT из локальных ресурсов (один раз за процесс).
+    * name : str
+        Название токенизатора (по умолчанию "sberbank-ai/ruBert-base").
+
+    Возвращает:
+    * BertTokenizerFast : Токенизатор.
+    """
+    from transformers import BertTokenizerFast
+
+    return BertTokenizerFast.from_pretrained(
+        resolve_model_path(name), local_files_only=True, clean_up_tokenization_spaces=True
+    )
+
+
+def bootstrap() -> None:
+    """Скачивает все необходимые ресурсы в RESOURCE_DIR."""
+    import nltk
+    from transformers import AutoModel, AutoTokenizer, BertTokenizerFast
+
+    os.makedirs(NLTK_DIR, exist_ok=True)
+    for package in NLTK_PACKAGES:
+        print(f"NLTK: {package}")
+        if not nltk.download(package, download_dir=NLTK_DIR, quiet=True):
+            raise RuntimeError(f"Не удалось скачать ресурс NLTK {package}")
+
+    print(f"HuggingFace: {BERT_TOKENIZER_NAME}")
+    # Быстрый токенизатор сохраняет tokenizer.json, и при загрузке не нужно конвертировать словарь
+    BertTokenizerFast.from_pretrained(BERT_TOKENIZER_NAME).save_pretrained(
+        os.path.join(HF_DIR, BERT_TOKENIZER_NAME.replace("/", "__"))
+    )
+    for name in HF_MODELS:
+        print(f"HuggingFace: {name}")
+        target = os.path.join(HF_DIR, name.replace("/", "__"))
+        AutoTokenizer.from_pretrained(name).save_pretrained(target)
+        AutoModel.from_pretrained(name).save_pretrained(target)
+    print(f"Ресурсы сохранены в {os.path.abspath(RESOURCE_DIR)}")
+
+
+if __name__ == "__main__":
+    bootstrap()
@@ -0,0 +1,188 @@
+import os
+import typing as tp
+from collections import Counter
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+class CourseVocabulary:
+    """
+    Словарь TF-IDF курса, обученный один раз на комментариях всех задач и сохраненный на диск.
+    Кластеризация задачи только применяет его (transform), а переобучение выполняется явно
+    или когда доля незнакомых слов в новых комментариях заметно превышает исходную.
+    Тексты комментариев не сохраняются: для переобучения хранятся только частоты слов
+    и число документов, в которых встретилось слово, по наиболее частым словам курса.
+    """
+
+    # Во сколько раз статистика слов больше словаря: редкие слова отбрасываются, чтобы файл не рос без предела
+    stats_factor = 20
+
+    def __init__(
+        self,
+        path: str,
+        stop_words: tp.Optional[tp.List[str]] = None,
+        max_features: int = 1000,
+        drift_threshold: float = 0.1,
+    ):
+        """
+        Загружает словарь, если он уже сохранен.
+        * path : str
+            Путь к файлу словаря (joblib).
+        * stop_words : list[str] | None
+            Стоп-слова векторизатора.
+        * max_features : int
+            Размер словаря (по умолчанию 1000).
+        * drift_threshold : float
+            Допустимый рост доли незнакомых слов относительно корпуса обучения (по умолчанию 0.1).
+        """
+        self.path = path
+        self.stop_words = stop_words
+        self.max_features = max_features
+        self.drift_threshold = drift_threshold
+        self.vectorizer = None
+        self.term_counts: Counter = Counter()
+        self.doc_counts: Counter = Counter()
+        self.n_docs = 0
+        self.baseline_oov = 0.0
+        if os.path.exists(path):
+            state = joblib.load(path)
+            self.vectorizer, self.baseline_oov = state["vectorizer"], state["baseline_oov"]
+            if "corpus" in state:
+                # Файл прежнего формата с текстами комментариев: при следующем сохранении останется только статистика
+                self._count(state["corpus"])
+            else:
+                self.term_counts, self.doc_counts = Counter(state["term_counts"]), Counter(state["doc_counts"])
+                self.n_docs = state["n_docs"]
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.vectorizer is not None
+
+    def fit(self, corpus: tp.List[str]) -> "CourseVocabulary":
+        """
+        Обучает словарь на корпусе курса и сохраняет его.
+        * corpus : list[str]
+            Комментарии курса.
+
+        Возвращает:
+        * CourseVocabulary : self.
+        """
+        self.term_counts, self.doc_counts, self.n_docs = Counter(), Counter(), 0
+        corpus = list(dict.fromkeys(text for text in corpus if text))
+        self._count(corpus)
+        self._build(corpus)
+        return self
+
+    def _analyzer(self) -> tp.Callable[[str], tp.List[str]]:
+        return TfidfVectorizer(stop_words=self.stop_words).build_analyzer()
+
+    def _count(self, corpus: tp.List[str]) -> None:
+        """
+        Добавляет к статистике курса частоты слов корпуса и оставляет только наиболее частые слова.
+        * corpus : list[str]
+            Комментарии.
+        """
+        analyzer = self._analyzer()
+        for text in corpus:
+            tokens = analyzer(text)
+            self.term_counts.update(tokens)
+            self.doc_counts.update(set(tokens))
+        self.n_docs += len(corpus)
+        limit = self.stats_factor * self.max_features
+        if len(self.term_counts) > limit:
+            self.term_counts = Counter(dict(self.term_counts.most_common(limit)))
+            self.doc_counts = Counter({term: self.doc_counts[term] for term in self.term_counts})
+
+    def _build(self, corpus: tp.List[str]) -> None:
+        """
+        Строит векторизатор по статистике курса так же, как TfidfVectorizer.fit по всему корпусу:
+        max_features самых частых слов и сглаженный idf, — и сохраняет словарь.
+        * corpus : list[str]
+            Новые комментарии (для доли незнакомых слов).
+        """
+        top = sorted(self.term_counts, key=lambda term: (-self.term_counts[term], term))[: self.max_features]
+        terms = sorted(top)
+        vectorizer = TfidfVectorizer(stop_words=self.stop_words, vocabulary=terms)
+        df = np.array([self.doc_counts[term] for term in terms], dtype=np.float64)
+        vectorizer.idf_ = np.log((1 + self.n_docs) / (1 + df)) + 1
+        self.vectorizer = vectorizer
+        self.baseline_oov = self.oov_rate(corpus)
+        self.save()
+        print(f"Словарь TF-IDF обучен на {self.n_docs} комментариях: {len(terms)} слов")
+
+    def save(self) -> None:
+        """Сохраняет словарь (через временный файл, чтобы не оставить поврежденный файл)."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        state = {
+            "vectorizer": self.vectorizer,
+            "term_counts": dict(self.term_counts),
+            "doc_counts": dict(self.doc_counts),
+            "n_docs": self.n_docs,
+            "baseline_oov": self.baseline_oov,
+        }
+        joblib.dump(state, self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+
+    def oov_rate(self, strings: tp.List[str]) -> float:
+        """
+        Доля словоупотреблений (без стоп-слов), которых нет в словаре.
+        * strings : list[str]
+            Комментарии.
+
+        Возвращает:
+        * float : Доля от 0 до 1 (0 для пустого набора).
+        """
+        analyzer = self.vectorizer.build_analyzer()
+        vocabulary = self.vectorizer.vocabulary_
+        total = unknown = 0
+        for text in strings:
+            tokens = analyzer(text)
+            total += len(tokens)
+            unknown += sum(token not in vocabulary for token in tokens)
+        return unknown / total if total else 0.0
+
+    def drift(self, strings: tp.List[str]) -> float:
+        """
+        Рост доли незнакомых слов в комментариях относительно корпуса, на котором обучен словарь.
+        * strings : list[str]
+            Комментарии.
+
+        Возвращает:
+        * float : Разность долей незнакомых слов.
+        """
+        return self.oov_rate(strings) - self.baseline_oov
+
+    def update(self, strings: tp.List[str], force: bool = False) -> bool:
+        """
+        Обучает словарь, если он еще не обучен, если force=True или если дрейф словаря превышает порог.
+        При переобучении частоты слов новых комментариев добавляются к статистике курса.
+        * strings : list[str]
+            Новые комментарии.
+        * force : bool
+            Переобучить словарь в любом случае.
+
+        Возвращает:
+        * bool : Был ли словарь переобучен.
+        """
+        if self.is_fitted and not force:
+            drift = self.drift(strings)
+            if drift <= self.drift_threshold:
+                return False
+            print(f"Дрейф словаря TF-IDF {drift:.2f} превышает {self.drift_threshold:.2f}, словарь обучается заново")
+        strings = list(dict.fromkeys(text for text in strings if text))
+        self._count(strings)
+        self._build(strings)
+        return True
+
+    def transform(self, strings: tp.List[str]):
+        """
+        Переводит строки в матрицу TF-IDF по словарю курса.
+        * strings : list[str]
+            Строки.
+
+        Возвращает:
+        * scipy.sparse.csr_matrix : Матрица TF-IDF размерности (N, max_features).
+        """
+        return self.vectorizer.transform(strings)